@@ -15,13 +15,53 @@
 #########################################
 
 AUDIO_DEVICE_ID = "3,0"       # change this number to use another soundcard
+SAMPLERATE = 44100                # Output sample rate; samples recorded at another rate are converted once, when loaded
+BLOCKSIZE = 512                   # Frames per audio callback: lower is less latency but more CPU (e.g. 128 on a Pi 4)
+CONFIG_FILE = "samplerbox.conf"   # Optional file of NAME = value lines overriding this config, if it exists
 SAMPLES_DIR = "."         # The root directory containing the sample-sets. Example: "/media/" to look for samples on a USB stick / SD card
 USE_SERIALPORT_MIDI = False       # Set to True to enable MIDI IN via SerialPort (e.g. RaspberryPi's GPIO UART pins)
+SERIALPORT_DEVICE = "/dev/ttyAMA0" # Serial port used for MIDI IN
+SERIALPORT_BAUDRATE = 38400       # see hack in /boot/cmdline.txt : 38400 is 31250 baud for MIDI!
 USE_I2C_7SEGMENTDISPLAY = False   # Set to True to use a 7-segment display via I2C
 USE_BUTTONS = False               # Set to True to use momentary buttons (connected to RaspberryPi's GPIO pins) to change preset
 USE_KEYBOARD = True               # Set to true to use keyboard '+' and '-' to increase/decrease presets
+MOCK_CONTROLS = False             # Set to True to print the display and read '+' / '-' on the console instead (tests without the hardware)
 MAX_POLYPHONY = 80                # This can be set higher, but 80 is a safe value
+MAX_VOICES_PER_NOTE = 8           # Voices a single key can hold (e.g. fast rolls on one drum pad) before its own voices are stolen
+VOICE_STEALING = ('released', 'quietest', 'oldest')   # Order of the rules choosing which voice to steal when all are playing
+USE_FUSED_MIX = True              # Mix, apply volume, soft clip and convert to int16 in a single pass without allocations
+MIX_THREADS = 0                   # Helper threads mixing voices in parallel with the audio thread (e.g. 3 on a Pi 4, then raise MAX_POLYPHONY)
+PARALLEL_MIX_MIN_VOICES = 24      # Below this number of voices, the audio thread mixes alone
+PARALLEL_MIX_DEADLINE = 0.5       # Fraction of the block the audio thread waits for the helpers; voices still mixing are deferred to the next block
+INTERPOLATION = "linear"          # Default resampling quality: "linear", "cubic" or "sinc" (presets can override it with %%interpolation)
+PITCH_RANGE = 84                  # Semitones of transposition + pitch bend covered by the pitch table, up and down
+PITCH_BEND_RANGE = 2              # Semitones of pitch bend at full wheel deflection
+TUNING_CENTS = 0                  # Global fine tuning in cents, e.g. 8 for A = 442 Hz (presets add %%tuning)
+PRESET_DOWN_CC = 102              # MIDI CC whose value >= 64 selects the previous preset (None to disable)
+PRESET_UP_CC = 103                # MIDI CC whose value >= 64 selects the next preset (None to disable)
+VELOCITY_CROSSFADE = False        # Set to True to blend the two nearest velocity layers of a note (presets can set %%velocitycrossfade)
+SAMPLE_ACCURATE_MIDI = True       # Play notes at their exact time within the audio block, one block later (else at the next block start)
+SOFT_CLIP_KNEE = 0.8              # Fraction of full scale above which the output is softly saturated (0 = hard clipping only)
+USE_DISK_STREAMING = False        # Set to True to keep only the beginning of one-shot samples in RAM and stream the rest from disk
+STREAMING_PRELOAD_MS = 500        # Length of the resident head of streamed samples; must cover the disk latency
+STREAMING_BUFFER_MS = 1000        # Length of the per-voice ring buffer refilled by the streaming thread
+USE_MIPMAPS = False               # Set to True to build filtered, decimated copies (one per octave) of samples transposed upwards
+MIPMAP_MAX_LEVELS = 6             # Highest octave level built (each level halves the sample rate)
+DITHER = False                    # Set to True to apply TPDF dither when reducing 24-bit, 32-bit and float samples to 16 bits
+LOADING_THREADS = 4               # Number of threads reading and decoding sample files during a preset load
+PROGRESSIVE_LOADING = True        # Make notes playable as their samples load (held keys and the middle of the keyboard first)
+USE_SAMPLE_CACHE = False          # Set to True to keep decoded samples on disk (memory-mapped at load) for fast preset loading
+SAMPLE_CACHE_DIR = "cache"        # Where the decoded sample cache is written, one index + one blob per preset folder
+PRESET_CACHE_MB = 0               # Memory budget for keeping recently used presets loaded (e.g. 300), 0 to disable
+USE_LIBRARY_WATCHER = True        # Set to True to refresh the preset index when a USB stick is plugged in or sample files change
+PRESET_CROSSFADE = True           # On a preset change, let the notes of the old preset ring out (released) instead of cutting them
+PRESET_PREFETCH = True            # Load preset-1 and preset+1 into the cache in the background (needs PRESET_CACHE_MB)
+METRICS_PORT = 0                  # Serve Prometheus metrics (callback load, xruns, voices, MIDI latency, loads) over HTTP on this port, e.g. 9109
+METRICS_TEXTFILE = None           # Or write them to this file, e.g. "/var/lib/node_exporter/samplerbox.prom"
+METRICS_INTERVAL = 10             # Seconds between textfile updates
+RENDER_PROCESSES = 0              # Processes rendering MIDI files in parallel in render mode (0: one per CPU core)
 DEBUG = False
+CONFIG_NAMES = set(name for name in dir() if name.isupper())     # what a config file or NAME=value argument may set
 
 #########################################
 # IMPORT
@@ -36,13 +76,21 @@ import time
 import numpy
 import os
 import re
-import sounddevice
 import threading
+import collections
+import itertools
+import concurrent.futures
+import hashlib
+import bisect
+import math
+import json
+import ast
+import multiprocessing
+import queue
 from chunk import Chunk
 import struct
-import rtmidi2 as rtmidi
 import samplerbox_audio
-from sys import argv as sys_argv
+from sys import argv as sys_argv, stdin as sys_stdin
 from signal import signal, SIGTERM, SIGINT
 from traceback import format_exc as traceback_format_exc
 
@@ -55,29 +103,77 @@ def signal_handler(signal,  frame):
     print("Exit")
     exit(0)
 
-
-### Signals attachment ###
-signal(SIGTERM, signal_handler) # SIGTERM (kill pid) to signal_handler
-signal(SIGINT, signal_handler)  # SIGINT (Ctrl+C) to signal_handler
-
 ####################################################################################################
 
 ### Check for input arguments ###
 
-argv = sys_argv[1:]
-argc = len(sys_argv)-1
-for arg in argv:
-    if arg == "debug":
-        DEBUG = True
-    elif arg == "devices":
-        print(sounddevice.query_devices())
-        exit(0)
-    else:
-        try:
-            AUDIO_DEVICE_ID = int(arg)
-        except ValueError:
+def parse_args(argv):
+    '''Apply command line arguments (debug, devices, config=<file>, NAME=value, <audio device id>) to the config'''
+    global DEBUG, AUDIO_DEVICE_ID
+    overrides = [arg for arg in argv if '=' in arg]
+    configfile = dict(arg.split('=', 1) for arg in overrides).get('config', CONFIG_FILE)
+    if os.path.isfile(configfile):
+        LoadConfig(configfile)
+    elif configfile != CONFIG_FILE:
+        print("Error: config file {} not found".format(configfile))
+        exit(1)
+    for arg in argv:
+        if arg in overrides:
+            name, value = arg.split('=', 1)
+            if name != 'config':
+                SetConfig(name, value)
+        elif arg == "debug":
+            DEBUG = True
+        elif arg == "devices":
+            import sounddevice
             print(sounddevice.query_devices())
             exit(0)
+        else:
+            try:
+                AUDIO_DEVICE_ID = int(arg)
+            except ValueError:
+                import sounddevice
+                print(sounddevice.query_devices())
+                exit(0)
+
+
+def SetConfig(name, value):
+    '''Set a config variable (e.g. samplerate=48000 or BLOCKSIZE = 128), value as a Python literal or a bare string'''
+    name = name.strip().upper()
+    if name not in CONFIG_NAMES:
+        print("Error: unknown config variable {}".format(name))
+        exit(1)
+    try:
+        value = ast.literal_eval(value.strip())
+    except (ValueError, SyntaxError):
+        value = value.split('#', 1)[0].strip()
+    globals()[name] = value
+
+
+def LoadConfig(filename):
+    '''Read NAME = value lines (# comments) from a config file'''
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            name, sep, value = line.partition('=')
+            if not sep:
+                print("Error: bad line in {}: {}".format(filename, line))
+                exit(1)
+            SetConfig(name, value)
+
+
+def ApplyConfig():
+    '''Rebuild what the module computed from the config at import time, once the config file and arguments are applied'''
+    global SPEED, STREAMING_PRELOAD_FRAMES, STREAMING_BUFFER_FRAMES, voicepool, globalinterpolation, globaltuning, PresetCache
+    SPEED = numpy.power(2, numpy.arange(-PITCH_RANGE * 100, PITCH_RANGE * 100 + 1) / 1200.0).astype(numpy.float32)
+    STREAMING_PRELOAD_FRAMES = SAMPLERATE * STREAMING_PRELOAD_MS // 1000
+    STREAMING_BUFFER_FRAMES = SAMPLERATE * STREAMING_BUFFER_MS // 1000
+    voicepool = VoicePool(MAX_POLYPHONY)
+    globalinterpolation = INTERPOLATION_MODES[INTERPOLATION]
+    globaltuning = TUNING_CENTS
+    PresetCache = LRUPresetCache(PRESET_CACHE_MB * 2**20)
 
 ####################################################################################################
 
@@ -111,6 +207,16 @@ def preset_increase():
     preset = preset + 1
     set_preset(preset)
 
+
+def preset_previous():
+    '''Preset buttons: wrap around from 0 to 127'''
+    set_preset((preset - 1) % 128)
+
+
+def preset_next():
+    '''Preset buttons: wrap around from 127 to 0'''
+    set_preset((preset + 1) % 128)
+
 ####################################################################################################
 
 #########################################
@@ -118,6 +224,28 @@ def preset_increase():
 # TO READ CUE MARKERS & LOOP MARKERS
 #########################################
 
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+def cuemarkers(data):
+    '''Sample offsets of a cue chunk'''
+    numcue = struct.unpack('<i', data[:4])[0]
+    return [struct.unpack('<iiiiii', data[4 + 24 * i:28 + 24 * i])[5] for i in range(numcue)]
+
+
+def smplloops(data):
+    '''[start, end] of each loop of a smpl chunk, end being the last frame of the loop'''
+    manuf, prod, sampleperiod, midiunitynote, midipitchfraction, smptefmt, smpteoffs, numsampleloops, samplerdata = struct.unpack(
+        '<iiiiiiiii', data[:36])
+    loops = []
+    for i in range(numsampleloops):
+        cuepointid, type, start, end, fraction, playcount = struct.unpack('<iiiiii', data[36 + 24 * i:60 + 24 * i])
+        loops.append([start, end])
+    return loops
+
+
 class waveread(wave.Wave_read):
 
     def initfp(self, file):
@@ -147,61 +275,343 @@ class waveread(wave.Wave_read):
                 if not self._fmt_chunk_read:
                     raise Exception("Error: data chunk before fmt chunk")
                 self._data_chunk = chunk
+                self._data_offset = self._file.offset + chunk.offset      # absolute position of the samples in the file
                 self._nframes = chunk.chunksize // self._framesize
                 self._data_seek_needed = 0
             elif chunkname == b'cue ':
-                numcue = struct.unpack('<i', chunk.read(4))[0]
-                for i in range(numcue):
-                    id, position, datachunkid, chunkstart, blockstart, sampleoffset = struct.unpack('<iiiiii', chunk.read(24))
-                    self._cue.append(sampleoffset)
+                self._cue += cuemarkers(chunk.read())
             elif chunkname == b'smpl':
-                manuf, prod, sampleperiod, midiunitynote, midipitchfraction, smptefmt, smpteoffs, numsampleloops, samplerdata = struct.unpack(
-                    '<iiiiiiiii', chunk.read(36))
-                for i in range(numsampleloops):
-                    cuepointid, type, start, end, fraction, playcount = struct.unpack('<iiiiii', chunk.read(24))
-                    self._loops.append([start, end])
+                self._loops += smplloops(chunk.read())
             chunk.skip()
         if not self._fmt_chunk_read or not self._data_chunk:
             raise Exception("Error: fmt chunk and/or data chunk missing")
 
+    def _read_fmt_chunk(self, chunk):
+        wFormatTag, self._nchannels, self._framerate, dwAvgBytesPerSec, wBlockAlign = struct.unpack('<HHLLH', chunk.read(14))
+        sampwidth = struct.unpack('<H', chunk.read(2))[0]
+        if wFormatTag == WAVE_FORMAT_EXTENSIBLE:
+            cbsize, validbits, channelmask = struct.unpack('<HHL', chunk.read(8))
+            wFormatTag = struct.unpack('<H', chunk.read(16)[:2])[0]       # the subformat GUID starts with the format tag
+        if wFormatTag not in (WAVE_FORMAT_PCM, WAVE_FORMAT_IEEE_FLOAT):
+            raise Exception("Error: unsupported WAV format {}".format(wFormatTag))
+        self._ieee = wFormatTag == WAVE_FORMAT_IEEE_FLOAT
+        self._sampwidth = (sampwidth + 7) // 8
+        if not self._sampwidth or not self._nchannels:
+            raise Exception("Error: bad sample width or number of channels")
+        self._framesize = self._nchannels * self._sampwidth
+        self._comptype = 'NONE'
+        self._compname = 'not compressed'
+
+    def getieee(self):
+        return self._ieee
+
+    def getmarkers(self):
+        return self._cue
+
+    def getloops(self):
+        return self._loops
+
+    def getdataoffset(self):
+        return self._data_offset
+
+
+#########################################
+# FLAC AND OGG VORBIS SAMPLES
+# (decoded by libsndfile, loops read from the metadata)
+#########################################
+
+SAMPLE_EXTENSIONS = ('.wav', '.flac', '.ogg')
+
+
+def flacmetadata(f):
+    '''Vorbis comments and the RIFF chunks kept by "flac --keep-foreign-metadata" (smpl, cue...) of a FLAC file'''
+    comments, chunks = [], {}
+    if f.read(4) != b'fLaC':
+        raise Exception("Error: not a FLAC file")
+    last = False
+    while not last:
+        header = f.read(4)
+        if len(header) < 4:
+            break
+        last, blocktype, size = header[0] & 0x80, header[0] & 0x7f, struct.unpack('>I', b'\0' + header[1:])[0]
+        if blocktype == 4:                                  # VORBIS_COMMENT
+            comments = vorbiscomments(f.read(size))
+        elif blocktype == 2:                                # APPLICATION
+            block = f.read(size)
+            if block[:4] == b'riff' and len(block) >= 12:
+                chunks.setdefault(block[4:8], block[12:])
+        else:
+            f.seek(size, 1)
+    return comments, chunks
+
+
+def oggmetadata(f):
+    '''Vorbis comments of an Ogg Vorbis file: its second packet, reassembled from the first pages'''
+    packets, packet = [], b''
+    while len(packets) < 2:
+        header = f.read(27)
+        if len(header) < 27 or header[:4] != b'OggS':
+            break
+        lacing = f.read(header[26])
+        data = f.read(sum(lacing))
+        position = 0
+        for n in lacing:
+            packet += data[position:position + n]
+            position += n
+            if n < 255:                                     # a lacing value below 255 ends a packet
+                packets.append(packet)
+                packet = b''
+    if len(packets) < 2 or packets[1][:7] != b'\x03vorbis':
+        return []
+    return vorbiscomments(packets[1][7:])
+
+
+def vorbiscomments(data):
+    '''[(NAME, value)] of a Vorbis comment header'''
+    vendor = struct.unpack('<I', data[:4])[0]
+    position = 4 + vendor
+    count = struct.unpack('<I', data[position:position + 4])[0]
+    position += 4
+    comments = []
+    for i in range(count):
+        size = struct.unpack('<I', data[position:position + 4])[0]
+        name, sep, value = data[position + 4:position + 4 + size].decode('utf-8', 'replace').partition('=')
+        comments.append((name.upper(), value))
+        position += 4 + size
+    return comments
+
+
+def commentloops(comments):
+    '''[start, end] loop from LOOPSTART and LOOPLENGTH (or LOOPEND, last frame of the loop) comments'''
+    tags = dict(comments)
+    start = tags.get('LOOPSTART', tags.get('LOOP_START'))
+    if start is None:
+        return []
+    if 'LOOPLENGTH' in tags:
+        return [[int(start), int(start) + int(tags['LOOPLENGTH']) - 1]]
+    end = tags.get('LOOPEND', tags.get('LOOP_END'))
+    return [[int(start), int(end)]] if end is not None else []
+
+
+class compressedread:
+    '''FLAC / Ogg Vorbis reader with the interface of waveread used by Sound; readframes() returns 16-bit frames,
+    or 32-bit float ones when DITHER is set and the source has more resolution'''
+
+    def __init__(self, filename):
+        import soundfile
+        with open(filename, 'rb') as f:
+            if filename.lower().endswith('.flac'):
+                comments, chunks = flacmetadata(f)
+            else:
+                comments, chunks = oggmetadata(f), {}
+        self._loops = smplloops(chunks[b'smpl']) if b'smpl' in chunks else commentloops(comments)
+        self._cue = cuemarkers(chunks[b'cue ']) if b'cue ' in chunks else []
+        self._file = soundfile.SoundFile(filename)
+        self._ieee = DITHER and self._file.subtype not in ('PCM_16', 'PCM_S8', 'PCM_U8')
+        self._dtype = 'float32' if self._ieee else 'int16'
+
+    def getsampwidth(self):
+        return 4 if self._ieee else 2
+
+    def getnchannels(self):
+        return self._file.channels
+
+    def getframerate(self):
+        return self._file.samplerate
+
+    def getnframes(self):
+        return self._file.frames
+
+    def getieee(self):
+        return self._ieee
+
     def getmarkers(self):
         return self._cue
 
     def getloops(self):
         return self._loops
 
+    def getdataoffset(self):
+        return None                 # no byte offset of a frame: compressed samples are never streamed from disk
+
+    def readframes(self, n):
+        return self._file.read(n, dtype=self._dtype, always_2d=True).tobytes()
+
+    def close(self):
+        self._file.close()
+
+
+def opensample(filename):
+    if filename.lower().endswith(('.flac', '.ogg')):
+        return compressedread(filename)
+    return waveread(filename)
+
 
 #########################################
 # MIXER CLASSES
 #
 #########################################
 
-class PlayingSound:
+class PlayingSound(samplerbox_audio.Voice):
+
+    __slots__ = ('ring', 'token', 'slot', 'age')
 
-    def __init__(self, sound, note):
-        self.sound = sound
-        self.pos = 0
-        self.fadeoutpos = 0
-        self.isfadeout = False
-        self.note = note
+    def __init__(self, sound=None, note=0):
+        self.ring = None            # ring buffer kept by the voice for disk streaming, allocated on first use
+        self.token = 0              # id of the note-on, kept in playingnotes (VoicePool.play)
+        self.slot = -1              # index in VoicePool.active, -1 when idle
+        self.age = 0
+        if sound is not None:
+            self.start(sound, note)
+
+    def start(self, sound, note, gain=1.0):
+        self.setsound(sound, note, globalinterpolation, gain)     # typed state read by the mixer: position, fade, loop, data...
+        if sound.streamed:
+            if self.ring is None:
+                self.ring = numpy.empty(2 * STREAMING_BUFFER_FRAMES, numpy.int16)
+            self.stream = self.ring     # ring buffer of a disk streaming voice, refilled by StreamingReader
+            self.streamfilled = sound.headframes
 
     def fadeout(self, i):
         self.isfadeout = True
 
-    def stop(self):
-        try:
-            playingsounds.remove(self)
-        except:
-            pass
+    def level(self):
+        '''Rough loudness estimate used for voice stealing: velocity layer and release fade'''
+        level = self.sound.velocity / 127.0 * self.gain
+        if self.isfadeout:
+            level *= FADEOUT[min(self.fadeoutpos, FADEOUTLENGTH)]
+        return level
+
+
+#########################################
+# VOICE POOL
+#
+#########################################
+
+class VoicePool:
+    '''Fixed set of preallocated voices, started and released by the audio thread (Keymap.play, MidiEvent); other
+    threads queue the tokens of the voices to stop, applied at the start of each block, so that only the audio
+    thread touches voices.'''
+
+    def __init__(self, size):
+        self.voices = [PlayingSound() for i in range(size)]
+        self.free = list(self.voices)       # stack of idle voices
+        self.active = []                    # voices being mixed, in no particular order
+        self.bytoken = {}
+        self.notecount = {}
+        self.kills = collections.deque()        # append / popleft are atomic: lock-free hand-off from the other threads
+        self.tokens = itertools.count(1)
+        self.started = 0
+        self.stolen = 0
+        self.underruns = 0                  # disk streaming underruns of the stopped voices
+        self.victims = None                 # (voice, token) sorted once per block, best victim last
+        self.stealkeys = []
+        for rule in VOICE_STEALING:
+            if rule == 'released':
+                self.stealkeys.append(lambda v: not v.isfadeout)
+            elif rule == 'quietest':
+                self.stealkeys.append(lambda v: v.level())
+            elif rule == 'oldest':
+                self.stealkeys.append(lambda v: v.age)
+
+    # other threads
+
+    def kill(self, token):
+        self.kills.append(token)
+
+    # audio thread
+
+    def play(self, sound, note, gain=1.0, frame=0):
+        '''Start a voice at a frame of the block about to be mixed; returns its token'''
+        token = next(self.tokens)
+        self.start(token, sound, note, gain, frame)
+        return token
+
+    def releaseat(self, token, frame=0):
+        voice = self.bytoken.get(token)
+        if voice is not None and not voice.isfadeout and voice.releaseframe < 0:
+            voice.releaseframe = frame
+
+    def process(self):
+        '''Start of a block: stops the voices killed by the other threads'''
+        self.victims = None
+        kills = self.kills
+        while kills:
+            voice = self.bytoken.get(kills.popleft())
+            if voice is not None:
+                self.stop(voice)
+
+    def start(self, token, sound, note, gain, frame=0):
+        if self.notecount.get(note, 0) >= MAX_VOICES_PER_NOTE:
+            self.steal([v for v in self.active if v.note == note])
+        if not self.free:
+            self.steal()
+        voice = self.free.pop()
+        voice.start(sound, note, gain)
+        voice.startframe = frame
+        voice.token = token
+        voice.age = self.started
+        self.started += 1
+        voice.slot = len(self.active)
+        self.active.append(voice)
+        self.bytoken[token] = voice
+        self.notecount[note] = self.notecount.get(note, 0) + 1
+        if sound.streamed:
+            StreamingEvent.set()
+
+    def stealkey(self, voice):
+        return [key(voice) for key in self.stealkeys]
+
+    def steal(self, voices=None):
+        '''Stop the best victim among voices, or among all active voices (sorted once per block for chords and bursts)'''
+        if voices is None:
+            if self.victims is None:
+                self.victims = [(v, v.token) for v in sorted(self.active, key=self.stealkey, reverse=True)]
+            while self.victims:
+                voice, token = self.victims.pop()
+                if voice.slot >= 0 and voice.token == token:
+                    self.stop(voice)
+                    self.stolen += 1
+                    return
+            voices = self.active
+        self.stop(min(voices, key=self.stealkey))
+        self.stolen += 1
+
+    def stop(self, voice):
+        if voice.slot < 0:
+            return
+        last = self.active.pop()        # O(1) removal: the last active voice takes the freed slot
+        if last is not voice:
+            self.active[voice.slot] = last
+            last.slot = voice.slot
+        voice.slot = -1
+        del self.bytoken[voice.token]
+        self.notecount[voice.note] -= 1
+        self.underruns += voice.underruns
+        voice.sound = voice.data = voice.mipmaps = voice.stream = None
+        self.free.append(voice)
 
 
 class Sound:
 
-    def __init__(self, filename, midinote, velocity):
-        wf = waveread(filename)
+    CACHED_FIELDS = ('sampwidth', 'nchannels', 'channels', 'ieee', 'loop', 'nframes', 'streamed', 'headframes', 'dataoffset', 'pan')
+
+    def __init__(self, filename, midinote, velocity, cached=None, pan=0.0):
         self.fname = filename
         self.midinote = midinote
         self.velocity = velocity
+        self.pan = pan                  # -1 (left) .. 1 (right), applied by the mixer's pan law
+        if cached is not None:      # (fields, data, mipmaps) from the decoded sample cache, no file access
+            fields, self.data, self.mipmaps = cached
+            for name in self.CACHED_FIELDS:
+                setattr(self, name, fields.get(name))
+            return
+        wf = opensample(filename)
+        self.sampwidth = wf.getsampwidth()
+        self.nchannels = wf.getnchannels()
+        self.channels = 1 if self.nchannels == 1 else 2       # of self.data: mono samples stay mono
+        self.ieee = wf.getieee()
+        rate = wf.getframerate()
         if wf.getloops():
             self.loop = wf.getloops()[0][0]
             self.nframes = wf.getloops()[0][1] + 2
@@ -209,37 +619,394 @@ class Sound:
             self.loop = -1
             self.nframes = wf.getnframes()
 
-        self.data = self.frames2array(wf.readframes(self.nframes), wf.getsampwidth(), wf.getnchannels())
+        # files at another rate than SAMPLERATE are converted here and compressed ones decoded, so they are resident (the streaming thread reads raw frames)
+        self.streamed = USE_DISK_STREAMING and rate == SAMPLERATE and wf.getdataoffset() is not None and self.loop == -1 and self.nframes > STREAMING_PRELOAD_FRAMES
+        if self.streamed:       # only the head is resident, the rest is read by StreamingReader
+            self.headframes = STREAMING_PRELOAD_FRAMES
+            self.dataoffset = wf.getdataoffset()
+        else:
+            self.headframes = self.nframes
+            self.dataoffset = None
+
+        self.data = self.frames2array(wf.readframes(self.headframes), self.sampwidth, self.nchannels, self.ieee)
+        self.mipmaps = None
+        if rate != SAMPLERATE:
+            frames = self.data.reshape(-1, self.channels)[:self.nframes - 1]
+            looped = frames[self.loop:] if self.loop != -1 else frames[:0]
+            if len(looped):         # the converter must see the loop as continuous: frames after its end repeat its start
+                extra = 2 * RESAMPLE_TAPS * (rate // SAMPLERATE + 1)
+                frames = numpy.concatenate([frames] + [looped] * (extra // len(looped) + 1))[:len(frames) + extra]
+                self.data = frames.ravel()
+            self.data = resample(self.data, rate, SAMPLERATE, self.channels)
+            if self.loop != -1:
+                self.loop = int(round(self.loop * float(SAMPLERATE) / rate))
+                self.nframes = min(int(round((self.nframes - 2) * float(SAMPLERATE) / rate)) + 2, len(self.data) // self.channels)
+            else:
+                self.nframes = len(self.data) // self.channels
+            self.headframes = self.nframes
 
         wf.close()
 
-    def play(self, note):
-        snd = PlayingSound(self, note)
-        playingsounds.append(snd)
-        return snd
-
-    def frames2array(self, data, sampwidth, numchan):
-        if sampwidth == 2:
+    def buildmipmaps(self, levels):
+        '''Build half-band filtered copies of the sample, decimated by 2, 4, ... 2**levels, used by the mixer for high transpositions'''
+        if self.streamed or levels < 1:
+            return
+        mipmaps = [self.data]
+        x = self.data.reshape(-1, self.channels).astype(numpy.float32)
+        for level in range(levels):
+            if len(x) < 2 * len(MIPMAP_FILTER):
+                break
+            y = numpy.empty(((len(x) + 1) // 2, self.channels), numpy.float32)
+            for c in range(self.channels):
+                y[:, c] = numpy.convolve(x[:, c], MIPMAP_FILTER, 'same')[::2]
+            mipmaps.append(numpy.clip(numpy.round(y), -32768, 32767).astype(numpy.int16).ravel())
+            x = y
+        self.mipmaps = mipmaps if len(mipmaps) > 1 else None
+
+    def frames2array(self, data, sampwidth, numchan, ieee=False):
+        '''Decode 8/16/24/32-bit PCM or 32/64-bit float frames to int16, mono or interleaved stereo (the first two channels)'''
+        data = data[:len(data) - len(data) % (sampwidth * numchan)]
+        if ieee and sampwidth in (4, 8):
+            npdata = numpy.frombuffer(data, dtype='<f%d' % sampwidth) * 32768.0
+            npdata = quantize(npdata)
+        elif ieee:
+            raise Exception("Error: unsupported float sample width {}".format(sampwidth))
+        elif sampwidth == 1:
+            npdata = (numpy.frombuffer(data, dtype=numpy.uint8).astype(numpy.int16) - 128) << 8
+        elif sampwidth == 2:
             npdata = numpy.frombuffer(data, dtype=numpy.int16)
         elif sampwidth == 3:
-            npdata = samplerbox_audio.binary24_to_int16(data, len(data)/3)
-        if numchan == 1:
-            npdata = numpy.repeat(npdata, 2)
+            if DITHER:
+                padded = numpy.zeros((len(data) // 3, 4), numpy.uint8)      # 24-bit samples in the top bytes of an int32
+                padded[:, 1:] = numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, 3)
+                npdata = quantize(padded.view('<i4').ravel() / 65536.0)
+            else:
+                npdata = samplerbox_audio.binary24_to_int16(data, len(data)//3)
+        elif sampwidth == 4:
+            if DITHER:
+                npdata = quantize(numpy.frombuffer(data, dtype='<i4') / 65536.0)
+            else:
+                npdata = numpy.frombuffer(data, dtype='<i2')[1::2].copy()       # high 16 bits of each 32-bit sample
+        else:
+            raise Exception("Error: unsupported sample width {}".format(sampwidth))
+        if numchan > 2:
+            npdata = npdata.reshape(-1, numchan)[:, :2].ravel()
         return npdata
 
+
+def quantize(x):
+    '''Float samples in int16 units to int16, with TPDF dither (+/-1 LSB) if DITHER is set'''
+    if DITHER:
+        x = x + (numpy.random.random_sample(len(x)) - numpy.random.random_sample(len(x)))
+    return numpy.clip(numpy.round(x), -32768, 32767).astype(numpy.int16)
+
+
+RESAMPLE_TAPS = 32          # taps per output frame of the load-time sample rate converter (more when decimating)
+RESAMPLE_TABLES = {}        # (up, down) -> polyphase coefficients, shared by all samples at the same rate
+
+
+def resampletable(up, down):
+    '''Kaiser windowed-sinc lowpass split in `up` phases: row p weights the taps k-half+1 .. k+half around the
+    input position k + p/up, with the cutoff below the lower of the two Nyquist frequencies'''
+    table = RESAMPLE_TABLES.get((up, down))
+    if table is None:
+        ratio = min(1.0, float(up) / down)
+        half = int(math.ceil(RESAMPLE_TAPS / ratio)) // 2
+        d = numpy.arange(1 - half, half + 1)[None, :] - numpy.arange(up)[:, None] / float(up)
+        window = numpy.i0(8.0 * numpy.sqrt(numpy.clip(1 - (d / half) ** 2, 0, 1))) / numpy.i0(8.0)
+        table = numpy.sinc(0.95 * ratio * d) * window
+        table = RESAMPLE_TABLES[(up, down)] = (table / table.sum(axis=1, keepdims=True)).astype(numpy.float32)
+    return table
+
+
+def resample(data, fromrate, torate, channels=2):
+    '''Convert interleaved int16 from one sample rate to another (rational ratio up/down), vectorised over
+    the output frames: one multiply-add of every output frame per tap'''
+    g = math.gcd(fromrate, torate)
+    up, down = torate // g, fromrate // g
+    table = resampletable(up, down)
+    taps = table.shape[1]
+    half = taps // 2
+    x = data.reshape(-1, channels).astype(numpy.float32)
+    x = numpy.concatenate((numpy.zeros((half, channels), numpy.float32), x, numpy.zeros((taps, channels), numpy.float32)))
+    t = numpy.arange((len(data) // channels * up + down - 1) // down, dtype=numpy.int64) * down
+    base, phase = t // up + 1, t % up
+    y = numpy.zeros((len(t), channels), numpy.float32)
+    for j in range(taps):
+        y += table[phase, j][:, None] * x[base + j]
+    return quantize(y.ravel())
+
+
+class Keymap:
+    '''Dense (midinote, velocity) -> sample map. Each of the 128 x 128 cells indexes a layer (the round-robin
+    variants defined for one note and velocity); with velocity crossfades a cell blends two adjacent layers.'''
+
+    def __init__(self, samples, crossfade=False, nearest=False):
+        '''samples: {(midinote, velocity, seq): Sound} as defined by the preset, seq orders the round-robin variants;
+        nearest: notes without samples use the nearest note with samples (on either side) instead of the note below'''
+        layers = {}
+        for key in sorted(samples):
+            layers.setdefault(key[:2], []).append(samples[key])
+        self.layers = list(layers.values())
+        self.turn = [0] * len(self.layers)          # next round-robin variant of each layer
+        grid = numpy.full((128, 129), -1, numpy.int32)      # column 128: no layer
+        for i, (midinote, velocity) in enumerate(layers):
+            grid[midinote, velocity] = i
+        defined = grid[:, :128] >= 0
+        notes = numpy.arange(128)[:, None]
+        velocities = numpy.arange(128)
+        below = numpy.maximum.accumulate(numpy.where(defined, velocities, -1), axis=1)                     # nearest layer at or below
+        above = numpy.minimum.accumulate(numpy.where(defined, velocities, 128)[:, ::-1], axis=1)[:, ::-1]   # at or above
+        lower = grid[notes, numpy.where(below >= 0, below, above)]         # below the first layer, play the first layer
+        upper = numpy.full((128, 128), -1, numpy.int32)
+        blend = numpy.zeros((128, 128), numpy.float32)
+        if crossfade:
+            nextvelocity = numpy.hstack([above[:, 1:], numpy.full((128, 1), 128)])                            # strictly above
+            fading = (below >= 0) & (velocities > below) & (nextvelocity < 128)      # on a layer, it plays alone
+            upper = numpy.where(fading, grid[notes, nextvelocity], -1)
+            blend = numpy.where(fading, (velocities - below) / numpy.maximum(nextvelocity - below, 1).astype(numpy.float32), 0)
+        rows = numpy.maximum.accumulate(numpy.where(defined.any(axis=1), numpy.arange(128), -1))    # a note without samples uses the note below
+        if nearest:
+            above = numpy.minimum.accumulate(numpy.where(defined.any(axis=1), numpy.arange(128), 1000)[::-1])[::-1]
+            rows = numpy.where((rows < 0) | (above - numpy.arange(128) < numpy.arange(128) - rows), above, rows)
+            rows[rows >= 128] = -1
+        missing = (rows < 0)[:, None]
+        rows = rows.clip(0)
+        self.lower = numpy.where(missing, -1, lower[rows]).ravel()         # 16384 cells, indexed by midinote << 7 | velocity
+        self.upper = numpy.where(missing, -1, upper[rows]).ravel()
+        self.blend = numpy.where(missing, 0, blend[rows]).ravel()
+
+    def next(self, layer):
+        '''Next round-robin variant of a layer'''
+        variants = self.layers[layer]
+        turn = self.turn[layer]
+        self.turn[layer] = turn + 1
+        return variants[turn % len(variants)]
+
+    def play(self, midinote, velocity, frame=0):
+        '''Audio thread: start the voices of a note-on at a frame of the current block; returns their voice pool tokens'''
+        if not 0 <= midinote < 128:
+            return []
+        cell = midinote << 7 | velocity
+        layer = self.lower[cell]
+        if layer < 0:
+            return []
+        upper = self.upper[cell]
+        if upper < 0:
+            return [voicepool.play(self.next(layer), midinote, 1.0, frame)]
+        w = self.blend[cell]        # equal power crossfade between the two velocity layers
+        return [voicepool.play(self.next(layer), midinote, math.sqrt(1 - w), frame),
+                voicepool.play(self.next(upper), midinote, math.sqrt(w), frame)]
+
+    def highestnotes(self):
+        '''{Sound: highest midinote it is played at}, e.g. to size its mipmaps'''
+        top = numpy.full(len(self.layers), -1)
+        for cells in (self.lower, self.upper):
+            used = cells >= 0
+            numpy.maximum.at(top, cells[used], numpy.nonzero(used)[0] >> 7)
+        notes = {}
+        for variants, note in zip(self.layers, top.tolist()):
+            for sound in variants:
+                notes[sound] = max(notes.get(sound, -1), note)
+        return notes
+
+
 FADEOUTLENGTH = 30000
 FADEOUT = numpy.linspace(1., 0., FADEOUTLENGTH)            # by default, float64
 FADEOUT = numpy.power(FADEOUT, 6)
 FADEOUT = numpy.append(FADEOUT, numpy.zeros(FADEOUTLENGTH, numpy.float32)).astype(numpy.float32)
-SPEED = numpy.power(2, numpy.arange(0.0, 84.0)/12).astype(numpy.float32)
-
-samples = {}
+SPEED = numpy.power(2, numpy.arange(-PITCH_RANGE * 100, PITCH_RANGE * 100 + 1) / 1200.0).astype(numpy.float32)     # one ratio per cent, unison in the middle
+INTERPOLATION_MODES = {"linear": 0, "cubic": 1, "sinc": 2}
+INTERPOLATION_PHASES = 256
+x = numpy.arange(INTERPOLATION_PHASES, dtype=numpy.float64)[:, None] / INTERPOLATION_PHASES    # fractional position of each phase
+CUBIC_TABLE = numpy.hstack([-0.5*x**3 + x**2 - 0.5*x, 1.5*x**3 - 2.5*x**2 + 1,                # Catmull-Rom, taps at k-1 .. k+2
+                            -1.5*x**3 + 2*x**2 + 0.5*x, 0.5*x**3 - 0.5*x**2]).astype(numpy.float32)
+d = numpy.arange(-3, 5)[None, :] - x                                                           # distance of taps k-3 .. k+4
+SINC_TABLE = numpy.sinc(0.95 * d) * (0.42 + 0.5 * numpy.cos(numpy.pi * d / 4.5) + 0.08 * numpy.cos(2 * numpy.pi * d / 4.5))   # Blackman windowed
+SINC_TABLE = (SINC_TABLE / SINC_TABLE.sum(axis=1, keepdims=True)).astype(numpy.float32)
+del x, d
+samplerbox_audio.setinterpolation(INTERPOLATION_MODES["cubic"], CUBIC_TABLE)
+samplerbox_audio.setinterpolation(INTERPOLATION_MODES["sinc"], SINC_TABLE)
+MIPMAP_FILTER = numpy.sinc(0.45 * numpy.arange(-15, 16)) * numpy.blackman(31)     # half-band lowpass, cutoff at 0.9 * the decimated Nyquist
+MIPMAP_FILTER = (MIPMAP_FILTER / MIPMAP_FILTER.sum()).astype(numpy.float32)
+STREAMING_PRELOAD_FRAMES = SAMPLERATE * STREAMING_PRELOAD_MS // 1000
+STREAMING_BUFFER_FRAMES = SAMPLERATE * STREAMING_BUFFER_MS // 1000
+
+preset = 0                      # number of the current preset, set by main(), program changes and the controls
+keymap = Keymap({})
 playingnotes = {}
 sustainplayingnotes = []
 sustain = False
-playingsounds = []
+voicepool = VoicePool(MAX_POLYPHONY)
+mixworkers = None               # samplerbox_audio.MixWorkers when MIX_THREADS > 0
 globalvolume = 10 ** (-12.0/20)  # -12dB default global volume
 globaltranspose = 0
+globalinterpolation = INTERPOLATION_MODES[INTERPOLATION]
+globaltuning = TUNING_CENTS
+pitchbend = 0                   # in cents, read by the audio thread once per block
+midievents = collections.deque()    # (clock() time, message) from the MIDI threads, consumed by the audio thread
+clock = time.perf_counter           # time base of the MIDI events; the block clock of the file being rendered in render mode
+
+
+#########################################
+# METRICS
+#
+#########################################
+
+class Histogram:
+    '''Fixed buckets, as a Prometheus histogram: observe() is a bisect and two additions'''
+
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)      # last one: above all bounds
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, x):
+        self.counts[bisect.bisect_left(self.bounds, x)] += 1
+        self.sum += x
+        if x > self.max:
+            self.max = x
+
+    def lines(self, name, labels=''):
+        sep = ',' if labels else ''
+        total = 0
+        for bound, count in zip(self.bounds + ['+Inf'], self.counts):
+            total += count
+            yield '{}_bucket{{{}{}le="{}"}} {}'.format(name, labels, sep, bound, total)
+        yield '{}_sum{} {}'.format(name, '{' + labels + '}' if labels else '', self.sum)
+        yield '{}_count{} {}'.format(name, '{' + labels + '}' if labels else '', total)
+
+
+class Metrics:
+    '''Counters written by the audio, MIDI and loading threads without locks, read by the exporters. Each one has a
+    single writer thread, except midievents, incremented by every MIDI input thread: it may miss concurrent events.'''
+
+    def __init__(self):
+        self.started = time.time()
+        self.callbacks = 0
+        self.overruns = 0               # callbacks that took longer than the block they computed
+        self.xruns = 0                  # blocks flagged by the audio device
+        self.underflows = 0
+        self.latemixes = 0              # blocks output without the voices of a late mix helper
+        self.deferredvoices = 0
+        self.callbackload = Histogram([0.1, 0.25, 0.5, 0.75, 0.9, 1.0, 1.5, 2.0])      # callback duration / block duration
+        self.callbackseconds = 0.0      # last callback
+        self.callbackmax = 0.0
+        self.activevoices = 0
+        self.maxvoices = 0
+        self.midievents = 0
+        self.midilatency = Histogram([0.002, 0.005, 0.01, 0.015, 0.02, 0.03, 0.05, 0.1])   # event received -> heard
+        self.loads = {}                 # {preset: (seconds, resident bytes, memory-mapped bytes, files)}
+
+    def callback(self, seconds, frame_count, status):
+        self.callbacks += 1
+        self.callbackseconds = seconds
+        if seconds > self.callbackmax:
+            self.callbackmax = seconds
+        load = seconds * SAMPLERATE / frame_count
+        self.callbackload.observe(load)
+        if load > 1:
+            self.overruns += 1
+        if status:
+            self.xruns += 1
+            if status.output_underflow:
+                self.underflows += 1
+        n = len(voicepool.active)
+        self.activevoices = n
+        if n > self.maxvoices:
+            self.maxvoices = n
+
+    def loaded(self, num, seconds, loaded):
+        self.loads[num] = (seconds, loaded.nbytes(), loaded.nbytes(mapped=True), len(loaded.filetimes))
+
+    def render(self):
+        '''Prometheus text exposition format'''
+        lines = []
+
+        def metric(name, kind, helptext, value=None):
+            lines.append('# HELP {} {}'.format(name, helptext))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            if value is not None:
+                lines.append('{} {}'.format(name, value))
+
+        metric('samplerbox_uptime_seconds', 'gauge', 'Seconds since start.', time.time() - self.started)
+        metric('samplerbox_callbacks_total', 'counter', 'Audio callbacks run.', self.callbacks)
+        metric('samplerbox_callback_overruns_total', 'counter', 'Audio callbacks slower than their block.', self.overruns)
+        metric('samplerbox_xruns_total', 'counter', 'Blocks flagged by the audio device (any status).', self.xruns)
+        metric('samplerbox_output_underflows_total', 'counter', 'Output underflows reported by the audio device.', self.underflows)
+        metric('samplerbox_late_mixes_total', 'counter', 'Blocks output before a mix helper thread was done.', self.latemixes)
+        metric('samplerbox_deferred_voices_total', 'counter', 'Voices left out of a block by a late mix helper, played from there at the next one.', self.deferredvoices)
+        metric('samplerbox_callback_seconds', 'gauge', 'Duration of the last audio callback.', self.callbackseconds)
+        metric('samplerbox_callback_seconds_max', 'gauge', 'Longest audio callback since start.', self.callbackmax)
+        metric('samplerbox_callback_load_ratio', 'histogram', 'Audio callback duration over block duration.')
+        lines.extend(self.callbackload.lines('samplerbox_callback_load_ratio'))
+        metric('samplerbox_active_voices', 'gauge', 'Voices mixed in the last block.', self.activevoices)
+        metric('samplerbox_active_voices_max', 'gauge', 'Most voices mixed in one block since start.', self.maxvoices)
+        metric('samplerbox_max_polyphony', 'gauge', 'Size of the voice pool.', len(voicepool.voices))
+        metric('samplerbox_voices_started_total', 'counter', 'Voices started.', voicepool.started)
+        metric('samplerbox_voices_stolen_total', 'counter', 'Voices stopped early to free a voice.', voicepool.stolen)
+        metric('samplerbox_streaming_underruns_total', 'counter', 'Blocks where a disk streaming voice ran out of data.', voicepool.underruns)
+        metric('samplerbox_midi_events_total', 'counter', 'MIDI messages received.', self.midievents)
+        metric('samplerbox_midi_latency_seconds', 'histogram', 'From MIDI event reception to its frame at the output.')
+        lines.extend(self.midilatency.lines('samplerbox_midi_latency_seconds'))
+        metric('samplerbox_preset', 'gauge', 'Current preset.', preset)
+        metric('samplerbox_preset_load_seconds', 'gauge', 'Time to load each preset, last load.')
+        for num, (seconds, nbytes, mapped, files) in sorted(self.loads.items()):
+            lines.append('samplerbox_preset_load_seconds{{preset="{}"}} {}'.format(num, seconds))
+        metric('samplerbox_preset_sample_bytes', 'gauge', 'Resident sample memory of each loaded preset.')
+        for num, (seconds, nbytes, mapped, files) in sorted(self.loads.items()):
+            lines.append('samplerbox_preset_sample_bytes{{preset="{}"}} {}'.format(num, nbytes))
+        metric('samplerbox_preset_mapped_sample_bytes', 'gauge', 'Sample data of each loaded preset memory-mapped from the sample cache.')
+        for num, (seconds, nbytes, mapped, files) in sorted(self.loads.items()):
+            lines.append('samplerbox_preset_mapped_sample_bytes{{preset="{}"}} {}'.format(num, mapped))
+        with PresetCache.lock:
+            cached = sum(PresetCache.sizes.values())
+        metric('samplerbox_preset_cache_bytes', 'gauge', 'Resident sample memory held by the preset cache.', cached)
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def MetricsServer():
+    '''Serves metrics.render() on http://<box>:METRICS_PORT/metrics'''
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    try:
+        server = http.server.HTTPServer(('', METRICS_PORT), Handler)
+    except Exception:
+        print("Could not start metrics server on port {}".format(METRICS_PORT))
+        return
+    print("Metrics on http://0.0.0.0:{}/metrics".format(METRICS_PORT))
+    server.serve_forever()
+
+
+def MetricsTextfile():
+    '''Rewrites METRICS_TEXTFILE every METRICS_INTERVAL seconds, e.g. for the node_exporter textfile collector'''
+    while True:
+        try:
+            with open(METRICS_TEXTFILE + ".tmp", 'w') as f:
+                f.write(metrics.render())
+            os.replace(METRICS_TEXTFILE + ".tmp", METRICS_TEXTFILE)     # atomic: never read half written
+        except Exception:
+            _debug("Could not write metrics to {}".format(METRICS_TEXTFILE))
+        time.sleep(METRICS_INTERVAL)
 
 
 #########################################
@@ -248,34 +1015,79 @@ globaltranspose = 0
 #########################################
 
 def AudioCallback(outdata, frame_count, time_info, status):
-    global playingsounds
+    global keymap
+    started = time.perf_counter()
+    t0 = clock()
+    outputdelay = max(0.0, time_info.outputBufferDacTime - time_info.currentTime) if time_info else 0.0
+    if PendingPresets:
+        InstallPreset(PendingPresets.popleft())
+    if PendingKeymaps:
+        loaded, newkeymap = PendingKeymaps.popleft()
+        if loaded is installedpreset:       # more samples of the preset being loaded, notes held keep playing
+            keymap = newkeymap
+    voicepool.process()
+    while midievents:
+        received, message = midievents.popleft()
+        frame = 0
+        if SAMPLE_ACCURATE_MIDI:        # one block of constant latency: an event received x s before now plays x s before the block end
+            frame = min(max(frame_count - int(round((t0 - received) * SAMPLERATE)), 0), frame_count - 1)
+        try:
+            MidiEvent(message, frame)
+        except Exception:
+            _debug(traceback_format_exc())
+        metrics.midilatency.observe(t0 + outputdelay + float(frame) / SAMPLERATE - received)
     rmlist = []
-    playingsounds = playingsounds[-MAX_POLYPHONY:]
-    b = samplerbox_audio.mixaudiobuffers(playingsounds, rmlist, frame_count, FADEOUT, FADEOUTLENGTH, SPEED)
+    cents = pitchbend + globaltuning        # voices glide to the new pitch over the block
+    if USE_FUSED_MIX:
+        deferred = samplerbox_audio.mixaudio(voicepool.active, rmlist, outdata, frame_count, globalvolume, SOFT_CLIP_KNEE, FADEOUT, FADEOUTLENGTH,
+                                             SPEED, mixworkers, PARALLEL_MIX_MIN_VOICES, cents, PARALLEL_MIX_DEADLINE * frame_count / SAMPLERATE)
+        if deferred:
+            metrics.latemixes += 1
+            metrics.deferredvoices += deferred
+    else:
+        b = samplerbox_audio.mixaudiobuffers(voicepool.active, rmlist, frame_count, FADEOUT, FADEOUTLENGTH, SPEED, cents)
+        b *= globalvolume
+        outdata[:] = b.reshape(outdata.shape)
     for e in rmlist:
-        try:
-            playingsounds.remove(e)
-        except:
-            pass
-    b *= globalvolume
-    outdata[:] = b.reshape(outdata.shape)
+        voicepool.stop(e)
+    metrics.callback(time.perf_counter() - started, frame_count, status)
 
 def MidiCallback(message, time_stamp):
-    global playingnotes, sustain, sustainplayingnotes
+    '''MIDI threads: preset changes are applied here, note and controller events are timestamped for the audio thread'''
     global preset
     _debug("{} - {}\n".format(time_stamp, message))
+    metrics.midievents += 1
     messagetype = message[0] >> 4
     #messagechannel = (message[0] & 15) + 1
     note = message[1] if len(message) > 1 else None
+    velocity = message[2] if len(message) > 2 else None
+
+    if messagetype == 12:  # Program change
+        print("Program change {}".format(str(note)))
+        preset = note
+        LoadSamples()
+
+    elif (messagetype == 11) and (note == PRESET_DOWN_CC) and (velocity >= 64):  # Control Preset
+        preset_reduce()
+
+    elif (messagetype == 11) and (note == PRESET_UP_CC) and (velocity >= 64):
+        preset_increase()
+
+    else:
+        midievents.append((clock(), message))
+
+
+def MidiEvent(message, frame):
+    '''Audio thread: applies a note or controller event at a frame of the current block'''
+    global playingnotes, sustain, sustainplayingnotes, pitchbend
+    messagetype = message[0] >> 4
+    note = message[1] if len(message) > 1 else None
     midinote = note
     velocity = message[2] if len(message) > 2 else None
 
-    # Control Preset
-    if messagetype == 14:
-        if velocity == 0:
-            preset_reduce()
-        elif velocity == 126:
-            preset_increase()
+    if messagetype == 14:   # Pitch bend, 14-bit value centered on 8192
+        pitchbend = int(round(((velocity << 7 | note) - 8192) * PITCH_BEND_RANGE * 100 / 8192.0))
+        return
 
     if messagetype == 9 and velocity == 0:
         messagetype = 8
@@ -283,7 +1095,7 @@ def MidiCallback(message, time_stamp):
     if messagetype == 9:    # Note on
         midinote += globaltranspose
         try:
-            playingnotes.setdefault(midinote, []).append(samples[midinote, velocity].play(midinote))
+            playingnotes.setdefault(midinote, []).extend(keymap.play(midinote, velocity, frame))
         except:
             pass
 
@@ -294,17 +1106,12 @@ def MidiCallback(message, time_stamp):
                 if sustain:
                     sustainplayingnotes.append(n)
                 else:
-                    n.fadeout(50)
+                    voicepool.releaseat(n, frame)
             playingnotes[midinote] = []
 
-    elif messagetype == 12:  # Program change
-        print("Program change {}".format(str(note)))
-        preset = note
-        LoadSamples()
-
     elif (messagetype == 11) and (note == 64) and (velocity < 64):  # sustain pedal off
         for n in sustainplayingnotes:
-            n.fadeout(50)
+            voicepool.releaseat(n, frame)
         sustainplayingnotes = []
         sustain = False
 
@@ -312,266 +1119,951 @@ def MidiCallback(message, time_stamp):
         sustain = True
 
 
+#########################################
+# DISK STREAMING
+#
+#########################################
+
+StreamingEvent = threading.Event()
+STREAMING_MAX_OPEN_FILES = 64
+
+
+def RefillStream(snd, files, token, sound):
+    '''Read the frames following snd.streamfilled into the voice's ring buffer, without overwriting unplayed frames.
+    token, sound: what the voice played when picked; the voice is dropped if the audio thread restarted it meanwhile.'''
+    ring = snd.stream
+    if snd.token != token or sound is None or ring is None:       # the voice ended meanwhile
+        return
+    ringframes = len(ring) // sound.channels        # a mono voice holds twice as many frames
+    start = snd.streamfilled
+    end = min(sound.nframes, int(snd.pos) + ringframes - 8)      # keeps the frames read behind the position by the sinc interpolation
+    if end <= start or (end - start < ringframes // 4 and end < sound.nframes):
+        return
+    f = files.get(sound.fname)
+    if f is None:
+        if len(files) >= STREAMING_MAX_OPEN_FILES:
+            for old in files.values():
+                old.close()
+            files.clear()
+        f = files[sound.fname] = open(sound.fname, 'rb')
+    framesize = sound.sampwidth * sound.nchannels
+    f.seek(sound.dataoffset + start * framesize)
+    data = sound.frames2array(f.read((end - start) * framesize), sound.sampwidth, sound.nchannels, sound.ieee)
+    c = sound.channels
+    n = len(data) // c
+    if n == 0:
+        raise EOFError(sound.fname)
+    if snd.token != token:      # stopped and reused for another note during the read (the GIL was released)
+        return
+    a = start % ringframes
+    first = min(n, ringframes - a)
+    ring[c * a:c * (a + first)] = data[:c * first]
+    ring[:c * (n - first)] = data[c * first:]
+    if snd.token == token:      # frames above streamfilled are never read, so a stale write above is harmless
+        snd.streamfilled = start + n      # published last: the mixer only reads below streamfilled
+
+
+def StreamingReader():
+    files = {}
+    period = STREAMING_BUFFER_MS / 4000.0
+    while True:
+        StreamingEvent.wait(period)
+        StreamingEvent.clear()
+        for snd in list(voicepool.active):
+            token, sound = snd.token, snd.sound
+            if snd.stream is not None and sound is not None:
+                try:
+                    RefillStream(snd, files, token, sound)
+                except Exception:
+                    print("Streaming error: {}".format(sound.fname))
+                    voicepool.kill(token)
+
+
+#########################################
+# SAMPLE LIBRARY INDEX
+#
+#########################################
+
+class PresetMapping:
+    '''A preset folder scanned once: its definition.txt parameters, the sample files to load and the folder listing'''
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.volume = 1.0               # product of the %%volume lines
+        self.transpose = 0
+        self.interpolation = INTERPOLATION_MODES[INTERPOLATION]
+        self.tuning = 0
+        self.crossfade = VELOCITY_CROSSFADE
+        self.jobs = []                  # (filename, midinote, velocity, seq, definition line, pan), in definition order
+        self.definition = b''
+        entries = sorted((e.name, e.stat()) for e in os.scandir(dirname) if e.is_file())
+        self.listing = [(name, st.st_size, st.st_mtime_ns) for name, st in entries]      # for the sample cache key
+        names = [name for name, st in entries]
+        if "definition.txt" in names:
+            with open(os.path.join(dirname, "definition.txt"), 'rb') as f:
+                self.definition = f.read()
+            for line, pattern, defaultparams in self.parse(self.definition.decode('utf-8', 'replace')):
+                for fname in names:
+                    m = pattern.match(fname)
+                    if m:
+                        self.addjob(fname, m.groupdict(), defaultparams, line)
+        else:
+            names = set(names)
+            for midinote in range(0, 127):
+                for ext in SAMPLE_EXTENSIONS:
+                    if "%d%s" % (midinote, ext) in names:
+                        self.jobs.append((os.path.join(dirname, "%d%s" % (midinote, ext)), midinote, 127, 0, None, 0.0))
+                        break
+
+    def parse(self, text):
+        '''Applies the %%parameters, returns (line, compiled pattern, default params) for the sample lines'''
+        matchers = []
+        for i, pattern in enumerate(text.splitlines()):
+            try:
+                if r'%%volume' in pattern:        # %%paramaters are global parameters
+                    self.volume *= 10 ** (float(pattern.split('=')[1].strip()) / 20)
+                    continue
+                if r'%%transpose' in pattern:
+                    self.transpose = int(pattern.split('=')[1].strip())
+                    continue
+                if r'%%interpolation' in pattern:
+                    self.interpolation = INTERPOLATION_MODES[pattern.split('=')[1].strip().lower()]
+                    continue
+                if r'%%tuning' in pattern:
+                    self.tuning = int(round(float(pattern.split('=')[1].strip())))
+                    continue
+                if r'%%velocitycrossfade' in pattern:
+                    self.crossfade = pattern.split('=')[1].strip().lower() in ('1', 'true', 'on', 'yes')
+                    continue
+                if not pattern.strip():
+                    continue
+                defaultparams = {'midinote': '0', 'velocity': '127', 'notename': '', 'seq': '0', 'pan': '0'}
+                if len(pattern.split(',')) > 1:
+                    defaultparams.update(dict([item.split('=') for item in pattern.split(',', 1)[1].replace(' ', '').replace('%', '').split(',')]))
+                pattern = pattern.split(',')[0]
+                pattern = re.escape(pattern.strip()).replace(r"\%", "%")        # re.escape only escapes % before Python 3.7
+                pattern = pattern.replace(r"%midinote", r"(?P<midinote>\d+)").replace(r"%velocity", r"(?P<velocity>\d+)")\
+                                 .replace(r"%notename", r"(?P<notename>[A-Ga-g]#?[0-9])").replace(r"%seq", r"(?P<seq>\d+)")\
+                                 .replace(r"\*", r".*?").strip()    # .*? => non greedy
+                pattern = re.sub(r"\\\.wav$", r"\.(?:wav|flac|ogg)", pattern, flags=re.IGNORECASE)     # .wav lines also match the compressed files
+                matchers.append((i+1, re.compile(pattern), defaultparams))
+            except:
+                print("Error in definition file, skipping line {}.".format(i+1))
+        return matchers
+
+    def addjob(self, fname, info, defaultparams, line):
+        try:
+            midinote = int(info.get('midinote', defaultparams['midinote']))
+            velocity = int(info.get('velocity', defaultparams['velocity']))
+            notename = info.get('notename', defaultparams['notename'])
+            seq = int(info.get('seq', defaultparams['seq']))      # round-robin variants of a note and velocity
+            pan = float(defaultparams['pan'])
+            if notename:
+                midinote = NOTES.index(notename[:-1].lower()) + (int(notename[-1])+2) * 12
+        except:
+            print("Error in definition file, skipping {} (line {}).".format(fname, line))
+            return
+        self.jobs.append((os.path.join(self.dirname, fname), midinote, velocity, seq, line, pan))
+
+
+class LibraryIndex:
+    '''In-memory table of the sample library: preset number -> folder -> PresetMapping. Folders are scanned
+    when first needed and rescanned only after LibraryWatcher reports a change.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.root = None
+        self.folders = None             # {preset number: folder}, None until scanned
+        self.mappings = {}              # {folder: PresetMapping}
+
+    def scan(self):
+        root = SAMPLES_DIR if os.listdir(SAMPLES_DIR) else '.'      # use current folder (containing 0 Saw) if no user media containing samples has been found
+        folders = {}
+        for name in sorted(os.listdir(root)):
+            num = name.split(' ', 1)[0]
+            if ' ' in name and num.isdigit() and str(int(num)) == num and int(num) not in folders and os.path.isdir(os.path.join(root, name)):
+                folders[int(num)] = os.path.join(root, name)
+        with self.lock:
+            self.root = root
+            self.folders = folders
+            self.mappings = {}
+        _debug("Library: {} presets in {}".format(len(folders), os.path.abspath(root)))
+
+    def folder(self, num):
+        if self.folders is None:
+            self.scan()
+        return self.folders.get(num)
+
+    def mapping(self, dirname):
+        with self.lock:
+            mapping = self.mappings.get(dirname)
+        if mapping is None:
+            mapping = PresetMapping(dirname)
+            with self.lock:
+                self.mappings[dirname] = mapping
+        return mapping
+
+    def invalidate(self, dirname=None):
+        '''Forget a folder's mapping, or everything (rescanning the root) when dirname is None'''
+        if dirname is None:
+            self.scan()
+        else:
+            with self.lock:
+                self.mappings.pop(dirname, None)
+        PresetCache.discard(dirname)
+
+
+Library = LibraryIndex()
+
+IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE, IN_DELETE_SELF = 0x2, 0x4, 0x8, 0x40, 0x80, 0x100, 0x200, 0x400
+IN_UNMOUNT, IN_IGNORED = 0x2000, 0x8000
+LIBRARY_EVENTS = IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+
+def LibraryWatcher():
+    '''Keeps Library up to date: inotify on the library root and preset folders, polling where inotify is missing.
+    The root is also checked every 2 s for a new mount (USB stick), which inotify does not report.'''
+    import ctypes
+    import ctypes.util
+    import select
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init()
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init")
+    except (OSError, AttributeError):
+        fd = None
+        print("Library watcher: inotify unavailable, polling")
+
+    def rootid():
+        try:
+            st = os.stat(SAMPLES_DIR)
+            return st.st_dev, st.st_ino, st.st_mtime_ns
+        except OSError:
+            return None
+
+    def watch():
+        if fd is None:
+            return {}
+        for wd in list(watches):
+            libc.inotify_rm_watch(fd, wd)
+        folders = {}
+        for path in [Library.root] + list((Library.folders or {}).values()):
+            wd = libc.inotify_add_watch(fd, os.fsencode(path), LIBRARY_EVENTS)
+            if wd >= 0:
+                folders[wd] = path
+        return folders
+
+    def foldertimes():
+        times = {}
+        for path in (Library.folders or {}).values():
+            try:
+                times[path] = os.stat(path).st_mtime_ns
+            except OSError:
+                times[path] = None
+        return times
+
+    def refresh(update, *args):
+        '''False if the library could not be read (e.g. a stick pulled out during the scan), retried later'''
+        try:
+            update(*args)
+            return True
+        except Exception:
+            print("\n[ERROR] {}".format(traceback_format_exc()))
+            return False
+
+    watches = {}
+    root = rootid()
+    if Library.folders is None and not refresh(Library.scan):
+        root = None
+    watches = watch()
+    times = foldertimes()
+    while True:
+        changed = set()
+        if fd is not None and select.select([fd], [], [], 2.0)[0]:
+            time.sleep(0.5)             # let a copy or a mount settle, then read all the pending events at once
+            data = os.read(fd, 65536)
+            offset = 0
+            while offset + 16 <= len(data):
+                wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+                offset += 16 + length
+                path = watches.get(wd)
+                if path is None or mask & IN_IGNORED:
+                    continue
+                if path == Library.root or mask & (IN_DELETE_SELF | IN_UNMOUNT):
+                    changed.add(None)
+                else:
+                    changed.add(path)
+        elif fd is None:
+            time.sleep(2)
+            current = foldertimes()
+            changed.update(path for path in current if current[path] != times.get(path))
+            times = current
+        current = rootid()
+        if current != root:
+            changed.add(None)
+            root = current
+        if None in changed:
+            print("Sample library changed, rescanning")
+            if not refresh(Library.invalidate):
+                root = None             # seen as changed at the next check
+            watches = watch()
+            times = foldertimes()
+        else:
+            for path in changed:
+                _debug("Library: {} changed".format(path))
+                if not refresh(Library.invalidate, path):
+                    root = None
+
+
 #########################################
 # LOAD SAMPLES
 #
 #########################################
 
 LoadingThread = None
-LoadingInterrupt = False
+LoadingEvent = threading.Event()
+LoadingGeneration = 0           # incremented by each request: a load is cancelled as soon as it is not the latest one
+PendingPresets = collections.deque(maxlen=1)     # LoadedPreset waiting for the audio thread to swap it in
+PendingKeymaps = collections.deque(maxlen=1)     # (LoadedPreset, Keymap) with more samples, for the preset being loaded
+installedpreset = None          # LoadedPreset swapped in last by the audio thread
+OfflineRender = False           # set in render mode
 
 
 def LoadSamples():
+    '''Request the loading of the current preset; returns at once (the MIDI thread never waits), a newer request cancels it'''
     global LoadingThread
-    global LoadingInterrupt
-
-    if LoadingThread:
-        LoadingInterrupt = True
-        LoadingThread.join()
-        LoadingThread = None
+    global LoadingGeneration
+    global PrefetchInterrupt
 
-    LoadingInterrupt = False
-    LoadingThread = threading.Thread(target=ActuallyLoad)
-    LoadingThread.daemon = True
-    LoadingThread.start()
+    LoadingGeneration += 1
+    PrefetchInterrupt = True            # after the increment: a superseded load finishing now cannot clear it
+    if OfflineRender:                   # render mode: program changes load in place, on the file's timeline
+        ActuallyLoad()
+        return
+    LoadingEvent.set()
+    if LoadingThread is None:
+        LoadingThread = StartThread(PresetLoader)
 
-NOTES = ["c", "c#", "d", "d#", "e", "f", "f#", "g", "g#", "a", "a#", "b"]
 
+def PresetLoader():
+    while True:
+        LoadingEvent.wait()
+        LoadingEvent.clear()
+        generation = LoadingGeneration
+        try:
+            ActuallyLoad(generation)
+        except Exception:               # e.g. a preset folder removed before the library rescan: the next request loads again
+            print("\n[ERROR] {}".format(traceback_format_exc()))
 
-def ActuallyLoad():
-    global preset
-    global samples
-    global playingsounds
-    global globalvolume, globaltranspose
-    playingsounds = []
-    samples = {}
-    globalvolume = 10 ** (-12.0/20)  # -12dB default global volume
-    globaltranspose = 0
-
-    samplesdir = SAMPLES_DIR if os.listdir(SAMPLES_DIR) else '.'      # use current folder (containing 0 Saw) if no user media containing samples has been found
-
-    basename = next((f for f in os.listdir(samplesdir) if f.startswith("%d " % preset)), None)      # or next(glob.iglob("blah*"), None)
-    if basename:
-        dirname = os.path.join(samplesdir, basename)
-    if not basename:
-        print("Preset empty: {}".format(preset))
-        display("E%03d" % preset)
-        return
-    print("Preset loading: {} ({})".format(preset, basename))
-    display("L%03d" % preset)
+NOTES = ["c", "c#", "d", "d#", "e", "f", "f#", "g", "g#", "a", "a#", "b"]
 
-    definitionfname = os.path.join(dirname, "definition.txt")
-    if os.path.isfile(definitionfname):
-        with open(definitionfname, 'r') as definitionfile:
-            for i, pattern in enumerate(definitionfile):
-                try:
-                    if r'%%volume' in pattern:        # %%paramaters are global parameters
-                        globalvolume *= 10 ** (float(pattern.split('=')[1].strip()) / 20)
-                        continue
-                    if r'%%transpose' in pattern:
-                        globaltranspose = int(pattern.split('=')[1].strip())
-                        continue
-                    defaultparams = {'midinote': '0', 'velocity': '127', 'notename': ''}
-                    if len(pattern.split(',')) > 1:
-                        defaultparams.update(dict([item.split('=') for item in pattern.split(',', 1)[1].replace(' ', '').replace('%', '').split(',')]))
-                    pattern = pattern.split(',')[0]
-                    pattern = re.escape(pattern.strip())
-                    pattern = pattern.replace(r"%midinote", r"(?P<midinote>\d+)").replace(r"\%velocity", r"(?P<velocity>\d+)")\
-                                     .replace(r"%notename", r"(?P<notename>[A-Ga-g]#?[0-9])").replace(r"\*", r".*?").strip()    # .*? => non greedy
-                    for fname in os.listdir(dirname):
-                        if LoadingInterrupt:
-                            return
-                        m = re.match(pattern, fname)
-                        if m:
-                            info = m.groupdict()
-                            midinote = int(info.get('midinote', defaultparams['midinote']))
-                            velocity = int(info.get('velocity', defaultparams['velocity']))
-                            notename = info.get('notename', defaultparams['notename'])
-                            if notename:
-                                midinote = NOTES.index(notename[:-1].lower()) + (int(notename[-1])+2) * 12
-                            samples[midinote, velocity] = Sound(os.path.join(dirname, fname), midinote, velocity)
-                except:
-                    print("Error in definition file, skipping line {}.".format(i+1))
 
-    else:
-        for midinote in range(0, 127):
-            if LoadingInterrupt:
+class LoadedPreset:
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.samples = {}           # (midinote, velocity, seq): Sound, as defined
+        self.keymap = None          # Keymap built from samples
+        self.crossfade = VELOCITY_CROSSFADE
+        self.volume = 10 ** (-12.0/20)  # -12dB default global volume
+        self.transpose = 0
+        self.interpolation = INTERPOLATION_MODES[INTERPOLATION]
+        self.tuning = 0             # cents, added to TUNING_CENTS
+        self.empty = True
+        self.loadtime = 0           # wall time spent decoding the samples, in seconds
+        self.filetimes = []         # (seconds, filename) for each decoded sample
+
+    def nbytes(self, mapped=False):
+        '''Resident sample memory, counting each Sound once; with mapped=True, the sample data memory-mapped from the
+        decoded sample cache instead (file pages the kernel reads in and drops as needed)'''
+        total = 0
+        for sound in set(self.samples.values()):
+            if sound:
+                for data in sound.mipmaps if sound.mipmaps else [sound.data]:
+                    if isinstance(data, numpy.memmap) == mapped:
+                        total += data.nbytes
+        return total
+
+
+def FindPresetDir(num):
+    return Library.folder(num)
+
+
+def BuildPreset(dirname, interrupted, publish=None):
+    '''Load all the samples of a preset folder into a new LoadedPreset; returns None if interrupted() became true.
+    publish(loaded), if given, is called while loading, loaded.keymap holding the samples decoded so far.'''
+    mapping = Library.mapping(dirname)
+    if USE_SAMPLE_CACHE:
+        loaded = LoadSampleCache(dirname)
+        if loaded is not None:
+            return loaded
+    loaded = LoadedPreset(dirname)
+    samples = loaded.samples
+    loaded.volume *= mapping.volume
+    loaded.transpose = mapping.transpose
+    loaded.interpolation = mapping.interpolation
+    loaded.tuning = mapping.tuning
+    loaded.crossfade = mapping.crossfade
+    def partial(samples):
+        loaded.keymap = Keymap(samples, loaded.crossfade, nearest=True)
+        loaded.empty = False
+        publish(loaded)
+    if not LoadSounds(mapping.jobs, samples, loaded, interrupted, partial if publish else None):
+        return None
+
+    loaded.empty = len(samples) == 0
+    loaded.keymap = Keymap(samples, loaded.crossfade)
+    if USE_MIPMAPS:
+        for sound, midinote in loaded.keymap.highestnotes().items():
+            if interrupted():
+                return None
+            sound.buildmipmaps(min(MIPMAP_MAX_LEVELS, (midinote - sound.midinote) // 12))
+    if USE_SAMPLE_CACHE:
+        SaveSampleCache(loaded)
+    return loaded
+
+
+def LoadSound(job, interrupted):
+    if interrupted():
+        return None, 0
+    t0 = time.time()
+    fname, midinote, velocity, seq, line, pan = job
+    return Sound(fname, midinote, velocity, pan=pan), time.time() - t0
+
+
+def LoadingPriority(transpose):
+    '''Sort key of the loading jobs: samples nearest to the keys held right now, then to the middle of the keyboard'''
+    held = [note - globaltranspose + transpose for note, voices in list(playingnotes.items()) if voices]
+
+    def priority(job):
+        fname, midinote, velocity, seq, line, pan = job
+        return (min(abs(midinote - note) for note in held) if held else 0, abs(midinote - 60), abs(velocity - 100), seq)
+    return priority
+
+
+PROGRESSIVE_INTERVAL = 0.05     # seconds between two keymaps published while loading
+
+
+def LoadSounds(jobs, samples, loaded, interrupted, publish=None):
+    '''Decode the jobs on LOADING_THREADS threads, the most urgent first, and fill samples in job order; returns False
+    if interrupted. publish(samples decoded so far) is called at the first one, then every PROGRESSIVE_INTERVAL.'''
+    t0 = time.time()
+    sounds = [None] * len(jobs)
+    lastpublish = None
+    order = range(len(jobs))
+    if publish:
+        priority = LoadingPriority(loaded.transpose)
+        order = sorted(order, key=lambda i: priority(jobs[i]))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=LOADING_THREADS) as pool:
+        futures = dict((pool.submit(LoadSound, jobs[i], interrupted), i) for i in order)       # the pool queue is FIFO
+        for future in concurrent.futures.as_completed(futures):
+            fname, midinote, velocity, seq, line, pan = jobs[futures[future]]
+            try:
+                sound, duration = future.result()
+            except Exception:
+                if line:
+                    print("Error in definition file, skipping {} (line {}).".format(os.path.basename(fname), line))
+                else:
+                    print("Error loading sample, skipping {}.".format(os.path.basename(fname)))
+                continue
+            if sound is None or interrupted():
+                for f in futures:
+                    f.cancel()
+                return False
+            sounds[futures[future]] = sound
+            loaded.filetimes.append((duration, fname))
+            if publish and (lastpublish is None or time.time() - lastpublish >= PROGRESSIVE_INTERVAL) and len(loaded.filetimes) < len(jobs):
+                publish(dict(((job[1], job[2], job[3]), sound) for job, sound in zip(jobs, sounds) if sound is not None))
+                lastpublish = time.time()
+    for job, sound in zip(jobs, sounds):        # in job order: a later definition line overrides an earlier one
+        if sound is not None:
+            samples[job[1], job[2], job[3]] = sound
+    loaded.loadtime = time.time() - t0
+    for duration, fname in sorted(loaded.filetimes, reverse=True):
+        _debug("  {:7.1f} ms  {}".format(duration * 1000, os.path.basename(fname)))
+    return True
+
+
+def ActuallyLoad(generation=None):
+    '''Build the current preset while the previous one keeps playing, then hand it to the audio thread;
+    generation: LoadingGeneration of the request (default: the latest), a newer request cancels the load'''
+    global PrefetchInterrupt
+    if generation is None:
+        generation = LoadingGeneration
+    interrupted = lambda: LoadingGeneration != generation
+    try:
+        t0 = time.time()
+        num = preset
+        published = []                          # partial keymaps handed to the audio thread (PROGRESSIVE_LOADING)
+
+        loaded = PresetCache.get(num)
+        cached = loaded is not None
+        if loaded is None:
+            dirname = FindPresetDir(num)
+            if not dirname:
+                print("Preset empty: {}".format(num))
+                display("E%03d" % num)
+                loaded = LoadedPreset(None)
+                loaded.keymap = Keymap({})
+                PendingPresets.append(loaded)
                 return
-            file = os.path.join(dirname, "%d.wav" % midinote)
-            if os.path.isfile(file):
-                samples[midinote, 127] = Sound(file, midinote, 127)
-
-    initial_keys = set(samples.keys())
-    for midinote in range(128):
-        lastvelocity = None
-        for velocity in range(128):
-            if (midinote, velocity) not in initial_keys:
-                samples[midinote, velocity] = lastvelocity
+            print("Preset loading: {} ({})".format(num, os.path.basename(dirname)))
+            display("L%03d" % num)
+
+            def publish(partial):
+                if interrupted() or num != preset:
+                    return
+                if not published:               # the first keymap swaps the preset in, the next ones only replace its keymap
+                    _debug("Preset playable: {} ({} files in {:.2f}s)".format(num, len(partial.filetimes), time.time() - t0))
+                    PendingPresets.append(partial)
+                else:
+                    PendingKeymaps.append((partial, partial.keymap))
+                published.append(partial)
+            loaded = BuildPreset(dirname, interrupted, publish if PROGRESSIVE_LOADING and not OfflineRender else None)
+            if loaded is None:
+                return
+            PresetCache.put(num, loaded)
+        if interrupted() or num != preset:      # superseded while loading: never swap in a stale preset
+            return
+
+        if published:
+            PendingKeymaps.append((loaded, loaded.keymap))      # complete keymap; the preset already plays (or is staged)
+        else:
+            PendingPresets.append(loaded)       # swapped in by the audio thread at the next block
+        metrics.loaded(num, time.time() - t0, loaded)
+        if not loaded.empty:
+            if cached:                          # loaded earlier (or prefetched): no decoding now
+                print("Preset loaded: {} (cached)".format(num))
+            elif loaded.filetimes:
+                print("Preset loaded: {} ({} files in {:.2f}s, {:.2f}s of decoding on {} threads)".format(
+                    num, len(loaded.filetimes), loaded.loadtime, sum(t for t, f in loaded.filetimes), LOADING_THREADS))
             else:
-                if not lastvelocity:
-                    for v in range(velocity):
-                        samples[midinote, v] = samples[midinote, velocity]
-                lastvelocity = samples[midinote, velocity]
-        if not lastvelocity:
-            for velocity in range(128):
-                try:
-                    samples[midinote, velocity] = samples[midinote-1, velocity]
-                except:
-                    pass
-    if len(initial_keys) > 0:
-        print("Preset loaded: {}".format(str(preset)))
-        display("%04d" % preset)
-    else:
-        print("Preset empty: {}".format(str(preset)))
-        display("E%03d" % preset)
+                print("Preset loaded: {}".format(str(num)))
+            display("%04d" % num)
+        else:
+            print("Preset empty: {}".format(str(num)))
+            display("E%03d" % num)
+    finally:
+        if generation == LoadingGeneration:     # a superseded load leaves the prefetch stopped for the newer one
+            PrefetchInterrupt = False
+            PrefetchEvent.set()
+
+
+def InstallPreset(loaded):
+    '''Audio thread, at a block boundary: the staged preset replaces the playing one. The notes of the old preset
+    are released (PRESET_CROSSFADE) and ring out while the new one plays, or cut.'''
+    global keymap, playingnotes, sustainplayingnotes, installedpreset
+    global globalvolume, globaltranspose, globalinterpolation, globaltuning
+    installedpreset = loaded
+    for voice in list(voicepool.active):
+        if PRESET_CROSSFADE:
+            voice.fadeout(50)
+        else:
+            voicepool.stop(voice)
+    playingnotes = {}
+    sustainplayingnotes = []
+    keymap = loaded.keymap
+    globalvolume = loaded.volume
+    globaltranspose = loaded.transpose
+    globalinterpolation = loaded.interpolation
+    globaltuning = TUNING_CENTS + loaded.tuning
 
 
 #########################################
-# OPEN AUDIO DEVICE
+# DECODED SAMPLE CACHE
 #
 #########################################
 
-try:
-    sd = sounddevice.OutputStream(device=AUDIO_DEVICE_ID, blocksize=512, 
-            samplerate=44100, channels=2, dtype='int16', callback=AudioCallback)
-    sd.start()
-    print("Opened audio device #{}".format(AUDIO_DEVICE_ID))
-except Exception:
-    print("\n[ERROR] {}".format(traceback_format_exc()))
-    print("Invalid audio device #{}".format(AUDIO_DEVICE_ID))
-    exit(1)
+SAMPLE_CACHE_VERSION = 6
+SAMPLE_CACHE_ALIGN = 32       # in int16 items: every sample starts on a 64-byte boundary in the blob
+
+
+def SampleCachePaths(dirname):
+    name = hashlib.sha1(os.path.abspath(dirname).encode('utf-8')).hexdigest()
+    return os.path.join(SAMPLE_CACHE_DIR, name + ".json"), os.path.join(SAMPLE_CACHE_DIR, name + ".bin")
+
+
+def SampleCacheKey(dirname):
+    '''Hash of the folder content (names, sizes, mtimes), of definition.txt and of the settings that change the decoded data'''
+    mapping = Library.mapping(dirname)      # listing from the library index, no folder scan
+    h = hashlib.sha1()
+    h.update(repr((SAMPLE_CACHE_VERSION, SAMPLERATE, DITHER, INTERPOLATION, USE_DISK_STREAMING, STREAMING_PRELOAD_FRAMES, USE_MIPMAPS, MIPMAP_MAX_LEVELS,
+                    VELOCITY_CROSSFADE)).encode('utf-8'))
+    for fname, size, mtime in mapping.listing:
+        h.update("{}:{}:{}\n".format(fname, size, mtime).encode('utf-8'))
+    h.update(mapping.definition)
+    return h.hexdigest()
+
+
+def LoadSampleCache(dirname):
+    '''Rebuild a LoadedPreset from the cache, with sample data memory-mapped from the blob; None if missing or stale'''
+    indexfname, blobfname = SampleCachePaths(dirname)
+    if not os.path.isfile(indexfname) or not os.path.isfile(blobfname):
+        return None
+    try:
+        with open(indexfname, 'r') as f:
+            index = json.load(f)
+        if index['key'] != SampleCacheKey(dirname):
+            return None
+        blob = numpy.memmap(blobfname, dtype=numpy.int16, mode='r') if os.path.getsize(blobfname) else numpy.zeros(0, numpy.int16)
+        loaded = LoadedPreset(dirname)
+        loaded.volume = index['volume']
+        loaded.transpose = index['transpose']
+        loaded.interpolation = index['interpolation']
+        loaded.tuning = index['tuning']
+        loaded.crossfade = index['crossfade']
+        sounds = []
+        for entry in index['sounds']:
+            segments = [blob[offset:offset + count] for offset, count in entry['segments']]
+            sounds.append(Sound(entry['fname'], entry['midinote'], entry['velocity'],
+                                cached=(entry, segments[0], segments if len(segments) > 1 else None)))
+        for midinote, velocity, seq, i in index['keys']:
+            loaded.samples[midinote, velocity, seq] = sounds[i]
+        loaded.empty = len(loaded.samples) == 0
+        loaded.keymap = Keymap(loaded.samples, loaded.crossfade)
+        _debug("Sample cache hit: {}".format(dirname))
+        return loaded
+    except Exception:
+        print("Sample cache unreadable, reloading: {}".format(dirname))
+        return None
+
+
+def SaveSampleCache(loaded):
+    '''Write the decoded samples of a preset as an aligned int16 blob plus a JSON index'''
+    indexfname, blobfname = SampleCachePaths(loaded.dirname)
+    try:
+        if not os.path.isdir(SAMPLE_CACHE_DIR):
+            os.makedirs(SAMPLE_CACHE_DIR)
+        key = SampleCacheKey(loaded.dirname)
+        sounds, keys, position = {}, [], 0
+        with open(blobfname + ".tmp", 'wb') as blob:
+            for (midinote, velocity, seq), sound in loaded.samples.items():
+                if sound not in sounds:
+                    entry = dict((name, getattr(sound, name)) for name in Sound.CACHED_FIELDS)
+                    entry.update(fname=sound.fname, midinote=sound.midinote, velocity=sound.velocity, segments=[])
+                    for data in (sound.mipmaps or [sound.data]):
+                        padding = -position % SAMPLE_CACHE_ALIGN
+                        blob.write(b'\0' * 2 * padding)
+                        position += padding
+                        blob.write(numpy.ascontiguousarray(data, dtype='<i2').tobytes())
+                        entry['segments'].append([position, len(data)])
+                        position += len(data)
+                    sounds[sound] = (len(sounds), entry)
+                keys.append([midinote, velocity, seq, sounds[sound][0]])
+        index = {'key': key, 'volume': loaded.volume, 'transpose': loaded.transpose, 'interpolation': loaded.interpolation, 'tuning': loaded.tuning, 'crossfade': loaded.crossfade,
+                 'sounds': [entry for i, entry in sorted(sounds.values(), key=lambda e: e[0])], 'keys': keys}
+        with open(indexfname + ".tmp", 'w') as f:
+            json.dump(index, f)
+        os.replace(blobfname + ".tmp", blobfname)
+        os.replace(indexfname + ".tmp", indexfname)      # the index is written last: it validates the blob
+    except Exception:
+        print("Could not write sample cache: {}".format(loaded.dirname))
+        _debug(traceback_format_exc())
 
 
 #########################################
-# KEYBOARD THREAD (NEEDS ROOT)
-#
+# PRESET CACHE
+# NEIGHBOUR PREFETCH
 #########################################
-if USE_KEYBOARD:
-    from keyboard import read_key as keyboard_read_key
 
-    def Keyboard():
-        global preset
-        try:
-            while True:
-                if keyboard_read_key() == '-':
-                    preset_reduce()
-                elif keyboard_read_key() == '+':
-                    preset_increase()
-                time.sleep(0.350)
-        except ImportError:
-            print("You need to be root to use keyboard")
+class LRUPresetCache:
+
+    def __init__(self, budget):
+        self.budget = budget        # bytes; 0 disables the cache
+        self.presets = collections.OrderedDict()
+        self.sizes = {}
+        self.lock = threading.Lock()
+
+    def __contains__(self, num):
+        with self.lock:
+            return num in self.presets
+
+    def get(self, num):
+        with self.lock:
+            loaded = self.presets.get(num)
+            if loaded is not None:
+                self.presets.move_to_end(num)
+            return loaded
+
+    def discard(self, dirname=None):
+        '''Drop the presets loaded from a folder (all of them when dirname is None), e.g. after the files changed'''
+        with self.lock:
+            for num in [n for n, loaded in self.presets.items() if dirname is None or loaded.dirname == dirname]:
+                del self.presets[num]
+                del self.sizes[num]
+
+    def put(self, num, loaded):
+        if not self.budget or loaded.empty:
+            return
+        size = loaded.nbytes()
+        with self.lock:
+            if size > self.budget:
+                return
+            self.presets[num] = loaded
+            self.sizes[num] = size
+            self.presets.move_to_end(num)
+            while sum(self.sizes.values()) > self.budget:      # evict least recently used, never the current preset
+                victim = next((n for n in self.presets if n != preset and n != num), None)
+                if victim is None:
+                    break
+                del self.presets[victim]
+                del self.sizes[victim]
+            _debug("Preset cache: {} ({} MB)".format(list(self.presets), sum(self.sizes.values()) // 2**20))
+
+
+PresetCache = LRUPresetCache(PRESET_CACHE_MB * 2**20)
+PrefetchEvent = threading.Event()
+PrefetchInterrupt = False
+
+
+def PresetPrefetcher():
+    '''Loads the neighbour presets into PresetCache while no preset is being loaded'''
+    while True:
+        PrefetchEvent.wait()
+        PrefetchEvent.clear()
+        for num in (preset + 1, preset - 1):
+            if PrefetchInterrupt or num < 0 or num in PresetCache:
+                continue
+            try:
+                dirname = FindPresetDir(num)
+                if not dirname:
+                    continue
+                _debug("Prefetching preset {}".format(num))
+                loaded = BuildPreset(dirname, lambda: PrefetchInterrupt)
+                if loaded is not None:
+                    PresetCache.put(num, loaded)
+            except Exception:
+                print("\n[ERROR] {}".format(traceback_format_exc()))
+
 
+#########################################
+# OPEN AUDIO DEVICE
+#
+#########################################
 
-    KeyboardThread = threading.Thread(target=Keyboard)
-    KeyboardThread.daemon = True
-    KeyboardThread.start()
+def OpenAudioDevice():
+    import sounddevice
+    global sd
+    try:
+        sd = sounddevice.OutputStream(device=AUDIO_DEVICE_ID, blocksize=BLOCKSIZE,
+                samplerate=SAMPLERATE, channels=2, dtype='int16', callback=AudioCallback)
+        sd.start()
+        print("Opened audio device #{}".format(AUDIO_DEVICE_ID))
+    except Exception:
+        print("\n[ERROR] {}".format(traceback_format_exc()))
+        print("Invalid audio device #{}".format(AUDIO_DEVICE_ID))
+        exit(1)
 
 
 #########################################
-# BUTTONS THREAD (RASPBERRY PI GPIO)
-#
+# CONTROL SURFACE
+# (DISPLAY, BUTTONS, KEYBOARD)
 #########################################
 
-if USE_BUTTONS:
-    import RPi.GPIO as GPIO
+class ControlSurface:
+    '''Display and preset buttons, kept off the loading and MIDI paths: show() only stores the latest text for the
+    display thread (texts shown meanwhile are skipped), inputs post actions to a single dispatcher thread'''
 
-    lastbuttontime = 0
+    def __init__(self):
+        self.displays = []              # backends with write(text)
+        self.inputs = []                # backends with start(post), calling post(action) from any thread
+        self.text = None
+        self.textevent = threading.Event()
+        self.actions = queue.Queue()
 
-    def Buttons():
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(18, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        GPIO.setup(17, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        global preset, lastbuttontime
+    def show(self, text):
+        self.text = text
+        self.textevent.set()
+
+    def post(self, action):
+        self.actions.put(action)
+
+    def displayloop(self):
+        written = None
         while True:
-            now = time.time()
-            if not GPIO.input(18) and (now - lastbuttontime) > 0.2:
-                lastbuttontime = now
-                preset -= 1
-                if preset < 0:
-                    preset = 127
-                LoadSamples()
+            self.textevent.wait()
+            self.textevent.clear()
+            text = self.text
+            if text == written:
+                continue
+            for backend in self.displays:
+                try:
+                    backend.write(text)
+                except Exception:
+                    _debug(traceback_format_exc())
+            written = text
 
-            elif not GPIO.input(17) and (now - lastbuttontime) > 0.2:
-                lastbuttontime = now
-                preset += 1
-                if preset > 127:
-                    preset = 0
-                LoadSamples()
+    def dispatchloop(self):
+        while True:
+            action = self.actions.get()
+            try:
+                CONTROL_ACTIONS[action]()
+            except Exception:
+                _debug(traceback_format_exc())
 
-            time.sleep(0.020)
+    def start(self):
+        for backend in self.inputs:
+            backend.start(self.post)
+        if self.displays:
+            StartThread(self.displayloop)
+        if self.inputs:
+            StartThread(self.dispatchloop)
 
-    ButtonsThread = threading.Thread(target=Buttons)
-    ButtonsThread.daemon = True
-    ButtonsThread.start()
 
+CONTROL_ACTIONS = {'down': preset_reduce, 'up': preset_increase,           # keyboard: stops at preset 0
+                   'previous': preset_previous, 'next': preset_next}       # buttons: wrap around, as they always did
 
-#########################################
-# 7-SEGMENT DISPLAY
-#
-#########################################
 
-if USE_I2C_7SEGMENTDISPLAY:
-    import smbus
+class I2CDisplay:
+    '''4-digit 7-segment display (serial command set) at I2C address 0x71'''
 
-    bus = smbus.SMBus(1)     # using I2C
+    def __init__(self):
+        import smbus
+        self.bus = smbus.SMBus(1)
 
-    def display(s):
-        for k in '\x76\x79\x00' + s:     # position cursor at 0
+    def write(self, text):
+        for k in '\x76\x79\x00' + text:     # clear, position cursor at 0
             try:
-                bus.write_byte(0x71, ord(k))
-            except:
+                self.bus.write_byte(0x71, ord(k))
+            except IOError:
                 try:
-                    bus.write_byte(0x71, ord(k))
-                except:
+                    self.bus.write_byte(0x71, ord(k))
+                except IOError:
                     pass
             time.sleep(0.002)
 
-    display('----')
-    time.sleep(0.5)
 
-else:
+class GPIOButtons:
+    '''Momentary buttons to ground on RaspberryPi GPIO pins (BCM numbers), read with edge interrupts'''
 
-    def display(s):
-        pass
+    PINS = {18: 'previous', 17: 'next'}
 
+    def start(self, post):
+        import RPi.GPIO as GPIO
+        GPIO.setmode(GPIO.BCM)
+        for pin, action in self.PINS.items():
+            GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+            GPIO.add_event_detect(pin, GPIO.FALLING, callback=lambda channel, action=action: post(action), bouncetime=200)
 
-#########################################
-# MIDI IN via SERIAL PORT
-#
-#########################################
 
-if USE_SERIALPORT_MIDI:
-    import serial
+class KeyboardInput:
+    ''''-' and '+' keys of a computer keyboard, through the keyboard module hooks (needs root)'''
 
-    ser = serial.Serial('/dev/ttyAMA0', baudrate=38400)       # see hack in /boot/cmline.txt : 38400 is 31250 baud for MIDI!
+    KEYS = {'-': 'down', '+': 'up'}
 
-    def MidiSerialCallback():
-        message = [0, 0, 0]
-        while True:
-            i = 0
-            while i < 3:
-                data = ord(ser.read(1))  # read a byte
-                if data >> 7 != 0:
-                    i = 0      # status byte!   this is the beginning of a midi message: http://www.midi.org/techspecs/midimessages.php
-                message[i] = data
-                i += 1
-                if i == 2 and message[0] >> 4 == 12:  # program change: don't wait for a third byte: it has only 2 bytes
-                    message[2] = 0
-                    i = 3
-            MidiCallback(message, None)
+    def start(self, post):
+        try:
+            import keyboard
+        except ImportError:
+            print("You need to be root to use keyboard")
+            return
+
+        def onpress(event):
+            if event.name in self.KEYS:
+                post(self.KEYS[event.name])
+        keyboard.on_press(onpress)
+
+
+class ConsoleDisplay:
+    '''Mock display: prints what the 7-segment display would show'''
+
+    def write(self, text):
+        print("Display: {}".format(text))
+
+
+class ConsoleInput:
+    '''Mock buttons: '-' and '+' characters typed on the standard input'''
+
+    KEYS = {'-': 'previous', '+': 'next'}
+
+    def start(self, post):
+        def read():
+            for line in sys_stdin:
+                for char in line:
+                    if char in self.KEYS:
+                        post(self.KEYS[char])
+        StartThread(read)
+
+
+controls = ControlSurface()
 
-    MidiThread = threading.Thread(target=MidiSerialCallback)
-    MidiThread.daemon = True
-    MidiThread.start()
+
+def display(s):
+    controls.show(s)
+
+
+def StartControls():
+    if USE_I2C_7SEGMENTDISPLAY:
+        controls.displays.append(I2CDisplay())
+    if USE_BUTTONS:
+        controls.inputs.append(GPIOButtons())
+    if USE_KEYBOARD:
+        controls.inputs.append(KeyboardInput())
+    if MOCK_CONTROLS:
+        controls.displays.append(ConsoleDisplay())
+        controls.inputs.append(ConsoleInput())
+    if controls.text is None:
+        display('----')
+    controls.start()
 
 
 #########################################
-# LOAD FIRST SOUNDBANK
+# MIDI IN via SERIAL PORT
 #
 #########################################
 
-preset = 0
-LoadSamples()
+MIDI_DATA_BYTES = [0] * 128 + [2] * 64 + [1] * 32 + [2] * 16 + [0, 1, 2, 1, 0, 0, 0, 0] + [0] * 8    # per status byte, 0 for data bytes
+MIDI_REALTIME = bytes(range(0xF8, 0x100))       # clock, start, stop... may appear anywhere, even inside a message
+
+
+class MidiStreamParser:
+    '''Incremental MIDI 1.0 byte stream parser: running status, realtime bytes between or inside messages,
+    SysEx skipped. feed() accepts chunks of any size and calls callback(message) for each complete message.'''
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.status = 0                 # running status (channel messages only), 0 if none
+        self.message = []               # message being assembled
+        self.needed = 0                 # its number of data bytes
+        self.sysex = False
+
+    def feed(self, data):
+        data = bytes(data).translate(None, MIDI_REALTIME)      # stripped in C: dense clock traffic costs nothing here
+        for byte in data:
+            if byte & 0x80:             # status byte: starts a message, ends any SysEx
+                self.sysex = byte == 0xF0
+                self.message = []
+                if byte < 0xF0:
+                    self.status = byte
+                else:
+                    self.status = 0             # system common messages cancel running status
+                    if byte == 0xF6:
+                        self.callback([byte])   # tune request, no data
+                    if MIDI_DATA_BYTES[byte] == 0:
+                        continue
+                self.message = [byte]
+                self.needed = MIDI_DATA_BYTES[byte]
+                continue
+            if self.sysex:
+                continue
+            if not self.message:
+                if not self.status:
+                    continue            # stray data byte
+                self.message = [self.status]            # running status: the status byte was omitted
+                self.needed = MIDI_DATA_BYTES[self.status]
+            self.message.append(byte)
+            if len(self.message) > self.needed:
+                message, self.message = self.message, []
+                self.callback(message)
+
+
+def MidiSerialCallback():
+    import serial
+    ser = serial.Serial(SERIALPORT_DEVICE, baudrate=SERIALPORT_BAUDRATE)
+    parser = MidiStreamParser(lambda message: MidiCallback(message, None))
+    while True:
+        parser.feed(ser.read(ser.in_waiting or 1))     # everything received so far, blocking only while nothing is
 
 
 #########################################
@@ -579,24 +2071,284 @@ LoadSamples()
 # MAIN LOOP
 #########################################
 
-midi_in = rtmidi.MidiInMulti()
-curr_ports = []
-prev_ports = []
-first_loop = True
-while True:
-    curr_ports = rtmidi.get_in_ports()
-    if (len(prev_ports) != len(curr_ports)):
-        midi_in.close_ports()
-        prev_ports = []
-    for port in curr_ports:
-        if port not in prev_ports and "Midi Through" not in port and (len(prev_ports) != len(curr_ports)):
-            midi_in.open_ports(port)
+class MidiPorts:
+    '''Open MIDI input ports, one rtmidi2.MidiIn each, kept in sync with the available ones: refresh() opens the new
+    ports and closes the vanished ones, without touching the others'''
+
+    def __init__(self):
+        import rtmidi2
+        self.rtmidi = rtmidi2
+        self.opened = {}                # {port name: MidiIn}
+
+    def available(self):
+        return set(port for port in self.rtmidi.get_in_ports() if "Midi Through" not in port)
+
+    def refresh(self):
+        current = self.available()
+        for port in sorted(set(self.opened) - current):
+            try:
+                self.opened.pop(port).close_port()
+            except Exception:
+                pass
+            print("Closed MIDI port: {}".format(port))
+        for port in sorted(current - set(self.opened)):
+            midi_in = self.rtmidi.MidiIn()
+            try:
+                midi_in.open_port(port)
+            except Exception:
+                print("Could not open MIDI port: {}".format(port))
+                continue
             midi_in.callback = MidiCallback
-            if first_loop:
-                print("Opened MIDI port: {}".format(port))
-                first_loop = False
-            else:
-                print("Reopening MIDI port: {}".format(port))
-            prev_ports = curr_ports
-    time.sleep(2)
+            self.opened[port] = midi_in
+            print("Opened MIDI port: {}".format(port))
+
+
+SND_SEQ_OPEN_INPUT = 2
+SND_SEQ_PORT_CAP_WRITE, SND_SEQ_PORT_CAP_SUBS_WRITE, SND_SEQ_PORT_CAP_NO_EXPORT = 1 << 1, 1 << 6, 1 << 7
+SND_SEQ_PORT_TYPE_APPLICATION = 1 << 20
+SND_SEQ_CLIENT_SYSTEM, SND_SEQ_PORT_SYSTEM_ANNOUNCE = 0, 1
+
+
+def AlsaAnnounceWaiter():
+    '''A function blocking until the ALSA sequencer announces a client or port change, or None without ALSA'''
+    import ctypes
+    import ctypes.util
+    try:
+        alsa = ctypes.CDLL(ctypes.util.find_library('asound') or 'libasound.so.2')
+        seq = ctypes.c_void_p()
+        if alsa.snd_seq_open(ctypes.byref(seq), b"default", SND_SEQ_OPEN_INPUT, 0) < 0:
+            return None
+        alsa.snd_seq_set_client_name(seq, b"SamplerBox hotplug")
+        port = alsa.snd_seq_create_simple_port(seq, b"announce", SND_SEQ_PORT_CAP_WRITE | SND_SEQ_PORT_CAP_SUBS_WRITE | SND_SEQ_PORT_CAP_NO_EXPORT,
+                                               SND_SEQ_PORT_TYPE_APPLICATION)
+        if port < 0 or alsa.snd_seq_connect_from(seq, port, SND_SEQ_CLIENT_SYSTEM, SND_SEQ_PORT_SYSTEM_ANNOUNCE) < 0:
+            return None
+    except (OSError, AttributeError):
+        return None
+    event = ctypes.c_void_p()
+
+    def wait():
+        alsa.snd_seq_event_input(seq, ctypes.byref(event))     # blocks until the next announce
+        time.sleep(0.2)                 # a device announces its client and each of its ports: handle them at once
+        alsa.snd_seq_drop_input(seq)
+    return wait
+
+
+def MidiPortsLoop():
+    '''Main loop: opens and closes MIDI ports as devices come and go, on ALSA announce events (else polling every 2 s)'''
+    ports = MidiPorts()
+    ports.refresh()
+    wait = AlsaAnnounceWaiter()
+    if wait is None:
+        print("No ALSA sequencer announce events: polling MIDI ports")
+    while True:
+        if wait is None:
+            time.sleep(2)
+        else:
+            wait()
+        ports.refresh()
+
+
+def StartThread(target):
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+#########################################
+# OFFLINE RENDER
+# MIDI FILE TO WAV
+#########################################
+
+RENDER_MAX_TAIL = 30            # seconds rendered at most after the last event, while voices still ring
+RenderPreset = None             # (preset number, LoadedPreset) loaded once before forking the render processes
+
+
+def ReadMidiVarLen(data, position):
+    value = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value = value << 7 | byte & 0x7F
+        if not byte & 0x80:
+            return value, position
+
+
+def ReadMidiFile(filename):
+    '''Channel messages of a Standard MIDI File (format 0 or 1) as [(seconds, message)], tracks merged, tempo map applied'''
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if data[:4] != b'MThd':
+        raise Exception("Error: {} is not a MIDI file".format(filename))
+    headersize = struct.unpack('>I', data[4:8])[0]
+    fmt, ntracks, division = struct.unpack('>HHh', data[8:14])
+    events = []                 # (tick, tempo or None, message or None)
+    position = 8 + headersize
+    while position + 8 <= len(data):
+        chunkname, size = data[position:position + 4], struct.unpack('>I', data[position + 4:position + 8])[0]
+        position += 8
+        if chunkname == b'MTrk':
+            track = data[position:position + size]
+            i, tick, status = 0, 0, 0
+            while i < len(track):
+                delta, i = ReadMidiVarLen(track, i)
+                tick += delta
+                byte = track[i]
+                if byte == 0xFF:                                    # meta event
+                    metatype = track[i + 1]
+                    length, i = ReadMidiVarLen(track, i + 2)
+                    if metatype == 0x51:
+                        events.append((tick, int.from_bytes(track[i:i + 3], 'big'), None))
+                    elif metatype == 0x2F:
+                        break
+                    i += length
+                    status = 0
+                    continue
+                if byte in (0xF0, 0xF7):                            # SysEx, skipped
+                    length, i = ReadMidiVarLen(track, i + 1)
+                    i += length
+                    status = 0
+                    continue
+                if byte & 0x80:
+                    status = byte
+                    i += 1
+                elif not status:
+                    raise Exception("Error: data byte without status in {}".format(filename))
+                n = MIDI_DATA_BYTES[status]
+                events.append((tick, None, [status] + list(track[i:i + n])))
+                i += n
+        position += size
+    events.sort(key=lambda e: e[0])     # stable: events of a tick keep their track order
+    if division < 0:                    # SMPTE: frames per second and ticks per frame
+        tickseconds = 1.0 / (-(division >> 8) * (division & 0xFF))
+    seconds, last, tempo, result = 0.0, 0, 500000, []
+    for tick, newtempo, message in events:
+        seconds += (tick - last) * (tickseconds if division < 0 else tempo / 1e6 / division)
+        last = tick
+        if newtempo is not None:
+            tempo = newtempo
+        else:
+            result.append((seconds, message))
+    return result
+
+
+def RenderMidiFile(midifile, wavfile):
+    '''Plays a MIDI file through MidiCallback and AudioCallback block by block, against a clock that advances one
+    block per callback, and writes the output; returns the seconds rendered'''
+    global preset, voicepool, playingnotes, sustainplayingnotes, sustain, pitchbend, clock
+    events = ReadMidiFile(midifile)
+    preset, loaded = RenderPreset
+    voicepool = VoicePool(MAX_POLYPHONY)        # every file starts from the same state: the output is deterministic
+    playingnotes, sustainplayingnotes, sustain, pitchbend = {}, [], False, 0
+    midievents.clear()
+    PendingPresets.append(loaded)
+    now = [0.0]
+    clock = lambda: now[0]
+    outdata = numpy.zeros((BLOCKSIZE, 2), numpy.int16)
+    files = {}
+    end = events[-1][0] if events else 0.0
+    w = wave.open(wavfile, 'wb')
+    w.setnchannels(2)
+    w.setsampwidth(2)
+    w.setframerate(SAMPLERATE)
+    i, block = 0, 0
+    while True:
+        blockend = float((block + 1) * BLOCKSIZE) / SAMPLERATE
+        while i < len(events) and events[i][0] < blockend:     # received during the block: placed at their frame
+            now[0] = events[i][0]
+            MidiCallback(events[i][1], events[i][0])
+            i += 1
+        now[0] = blockend
+        if USE_DISK_STREAMING:
+            for snd in list(voicepool.active):
+                if snd.stream is not None:
+                    RefillStream(snd, files, snd.token, snd.sound)
+        AudioCallback(outdata, BLOCKSIZE, None, None)
+        w.writeframesraw(outdata.tobytes())
+        block += 1
+        if i == len(events) and (not voicepool.active or blockend > end + RENDER_MAX_TAIL):
+            break
+    w.close()
+    for f in files.values():
+        f.close()
+    clock = time.perf_counter
+    return blockend
+
+
+def RenderJob(job):
+    midifile, wavfile = job
+    t0 = time.time()
+    try:
+        seconds = RenderMidiFile(midifile, wavfile)
+    except Exception:
+        print("Render error: {}".format(midifile))
+        _debug(traceback_format_exc())
+        return False
+    elapsed = time.time() - t0
+    print("Rendered {} -> {}: {:.1f}s of audio in {:.1f}s ({:.0f}x realtime)".format(
+        midifile, wavfile, seconds, elapsed, seconds / max(elapsed, 1e-6)))
+    return True
+
+
+def Render(args):
+    '''render <preset> <file.mid> [<file.mid> ...]: each MIDI file is rendered to a .wav of the same name, files
+    in parallel on RENDER_PROCESSES forked processes sharing the preset loaded once here'''
+    global preset, OfflineRender, RenderPreset
+    if len(args) < 2 or not args[0].isdigit():
+        print("usage: python3 samplerbox.py render <preset> <file.mid> [<file.mid> ...] [NAME=value ...]")
+        exit(1)
+    OfflineRender = True
+    preset = int(args[0])
+    ActuallyLoad()
+    RenderPreset = (preset, PendingPresets.popleft())
+    jobs = [(midifile, os.path.splitext(midifile)[0] + ".wav") for midifile in args[1:]]
+    processes = min(len(jobs), RENDER_PROCESSES or os.cpu_count() or 1)
+    if processes > 1:
+        with multiprocessing.get_context('fork').Pool(processes) as pool:
+            results = pool.map(RenderJob, jobs, chunksize=1)
+    else:
+        results = [RenderJob(job) for job in jobs]
+    if not all(results):
+        exit(1)
+
+
+def main():
+    global preset, mixworkers
+    signal(SIGTERM, signal_handler) # SIGTERM (kill pid) to signal_handler
+    signal(SIGINT, signal_handler)  # SIGINT (Ctrl+C) to signal_handler
+    if sys_argv[1:2] == ["render"]:     # offline: MIDI files to WAV, no soundcard
+        args = sys_argv[2:]
+        parse_args([arg for arg in args if '=' in arg or arg == "debug"])
+        ApplyConfig()
+        Render([arg for arg in args if '=' not in arg and arg != "debug"])
+        return
+    parse_args(sys_argv[1:])
+    ApplyConfig()
+
+    if MIX_THREADS > 0 and USE_FUSED_MIX:
+        mixworkers = samplerbox_audio.MixWorkers(MIX_THREADS)
+    OpenAudioDevice()
+    if USE_DISK_STREAMING:
+        StartThread(StreamingReader)
+    if PRESET_CACHE_MB and PRESET_PREFETCH:
+        StartThread(PresetPrefetcher)
+    if USE_LIBRARY_WATCHER:
+        StartThread(LibraryWatcher)
+    if METRICS_PORT:
+        StartThread(MetricsServer)
+    if METRICS_TEXTFILE:
+        StartThread(MetricsTextfile)
+    StartControls()
+    if USE_SERIALPORT_MIDI:
+        StartThread(MidiSerialCallback)
+
+    # Load first soundbank
+    preset = 0
+    LoadSamples()
+
+    MidiPortsLoop()
+
 
+if __name__ == "__main__":
+    main()
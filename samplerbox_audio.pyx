@@ -14,73 +14,644 @@ import cython
 import numpy
 cimport numpy
 
-def mixaudiobuffers(list playingsounds, list rmlist, int frame_count, numpy.ndarray FADEOUT, int FADEOUTLENGTH, numpy.ndarray SPEED):
-    cdef int i, ii, k, l, N, length, looppos, fadeoutpos
-    cdef float speed, newsz, pos, j
-    cdef numpy.ndarray b = numpy.zeros(2 * frame_count, numpy.float32)      # output buffer
-    cdef float* bb = <float *> (b.data)                                     # and its pointer
+from libc.string cimport memset
+from libc.stdlib cimport realloc
+from libc.math cimport tanhf, lrintf, cos, sin, M_PI, M_SQRT2
+import threading
+
+cdef extern from *:
+    int __sync_fetch_and_add(int *ptr, int value) nogil
+    void __sync_synchronize() nogil
+
+cdef extern from "sched.h" nogil:
+    int sched_yield()
+
+from posix.time cimport clock_gettime, timespec, CLOCK_MONOTONIC
+
+
+cdef class Voice:
+    # typed voice state read by the mixer; samplerbox.PlayingSound extends it
+    cdef public object sound, data, mipmaps, stream
+    cdef public int note, midinote, loop, length, headframes, fadeoutpos, streamfilled, underruns, interpolation
+    cdef public int channels                                                # 1: mono data, rendered to both sides; 2: interleaved stereo
+    cdef public int startframe, releaseframe                                # frames of the next block where the voice starts / is released (-1: not)
+    cdef public double pos
+    cdef public float speed                                                 # playback speed at the end of the last block, 0 before the first one
+    cdef public float gain
+    cdef public float panleft, panright                                     # per side gains of the pan law, 1 at the centre
+    cdef public bint isfadeout
+
+    def setsound(self, sound, int note, int interpolation=0, float gain=1.0):
+        cdef double pan = min(max(sound.pan, -1.0), 1.0)
+        self.sound = sound
+        self.gain = gain
+        self.channels = sound.channels
+        if pan == 0:
+            self.panleft = self.panright = 1
+        else:                                                               # equal power, normalised to unity at the centre
+            self.panleft = M_SQRT2 * cos((pan + 1) * M_PI / 4)
+            self.panright = M_SQRT2 * sin((pan + 1) * M_PI / 4)
+        self.interpolation = interpolation
+        self.data = sound.data
+        self.mipmaps = sound.mipmaps
+        self.midinote = sound.midinote
+        self.loop = sound.loop
+        self.length = sound.nframes
+        self.headframes = sound.headframes
+        self.note = note
+        self.pos = 0
+        self.speed = 0
+        self.fadeoutpos = 0
+        self.isfadeout = False
+        self.startframe = 0
+        self.releaseframe = -1
+        self.stream = None
+        self.streamfilled = 0
+        self.underruns = 0
+
+cdef struct VoiceState:
+    # C copy of a voice, prepared with the GIL, rendered without it, then written back to the Voice
+    short* data
+    short* ring
+    float* table                                                            # interpolation coefficients, phases x taps
+    int taps, phases, frames                                                # frames: readable frames in data (or filled)
+    int channels                                                            # int16 items per frame in data and ring
+    int ringframes, headframes, filled, length, loop, fadeoutpos, scale
+    int underrun, finished, n
+    int startframe, releaseframe
+    double pos
+    double speed0, speed1                                                   # speed ramp over the block, linear from speed0 to speed1
+    float gainleft, gainright                                               # gain times the pan law
+    bint fading, streamed
+
+cdef inline short* streamframe(short* head, int headframes, short* ring, int ringframes, int k, int channels) noexcept nogil:
+    # frames before headframes are resident, the following ones are in the voice's ring buffer
+    if k < headframes:
+        return head + channels * k
+    return ring + channels * (k % ringframes)
+
+# interpolation modes (0 is linear, computed inline); tables registered by samplerbox.py at import
+cdef list interpolationtables = [None] * 8
+cdef int[8] interpolationtaps
+cdef int[8] interpolationphases
+
+def setinterpolation(int mode, numpy.ndarray table):
+    # table: float32 array of shape (phases, taps); taps must be even, tap t is at frame k - taps/2 + 1 + t
+    if mode < 1 or mode >= 8 or table.ndim != 2 or table.shape[1] % 2:
+        raise ValueError("bad interpolation table")
+    table = numpy.ascontiguousarray(table, numpy.float32)
+    interpolationtables[mode] = table
+    interpolationphases[mode] = table.shape[0]
+    interpolationtaps[mode] = table.shape[1]
+
+cdef bint prepare(Voice snd, VoiceState* v, float* speeds, int nspeeds, int cents) except -1:
+    # fills v from the voice; speeds is the cent resolution ratio table, centered on its middle entry
+    cdef int level, idx
+    cdef double top
     cdef numpy.ndarray z
-    cdef short* zz
-    cdef float* fadeout = <float *> (FADEOUT.data)
+    idx = (snd.note - snd.midinote) * 100 + cents + nspeeds // 2
+    if idx < 0:
+        idx = 0
+    elif idx >= nspeeds:
+        idx = nspeeds - 1
+    v.speed1 = speeds[idx]
+    v.speed0 = snd.speed if snd.speed > 0 else v.speed1                    # glide from the last block's speed
+    v.pos = snd.pos
+    v.gainleft = snd.gain * snd.panleft
+    v.gainright = snd.gain * snd.panright
+    v.channels = snd.channels
+    v.fadeoutpos = snd.fadeoutpos
+    v.fading = snd.isfadeout
+    v.startframe = snd.startframe
+    v.releaseframe = -1 if snd.isfadeout else snd.releaseframe
+    v.loop = snd.loop
+    v.length = snd.length
+    v.underrun = v.finished = v.n = 0
+    v.scale = 1
+    v.taps = 2
+    if 0 < snd.interpolation < 8 and interpolationtables[snd.interpolation] is not None:
+        z = interpolationtables[snd.interpolation]
+        v.table = <float *> (z.data)
+        v.taps = interpolationtaps[snd.interpolation]
+        v.phases = interpolationphases[snd.interpolation]
+    z = snd.data
+    v.data = <short *> (z.data)
+    v.frames = len(z) // v.channels
+    v.streamed = snd.stream is not None
+    if v.streamed:                                                          # disk streaming voice (one-shot only)
+        z = snd.stream
+        v.ring = <short *> (z.data)
+        v.ringframes = len(z) // v.channels
+        v.headframes = snd.headframes
+        v.filled = snd.streamfilled
+        v.frames = min(v.filled, v.length)
+        return True
+    level = 0                                                               # decimated copies, one per octave
+    top = max(v.speed0, v.speed1)
+    if snd.mipmaps is not None:
+        while level + 1 < len(snd.mipmaps) and top >= (2 << level):
+            level += 1
+    if level > 0:                                                           # work in the coordinates of the decimated copy
+        z = snd.mipmaps[level]
+        v.data = <short *> (z.data)
+        v.frames = len(z) // v.channels
+        v.scale = 1 << level
+        v.pos /= v.scale
+        v.speed0 /= v.scale
+        v.speed1 /= v.scale
+        v.length >>= level
+        if v.loop != -1:
+            v.loop >>= level
+    return True
 
-    for snd in playingsounds:
-        pos = snd.pos
-        fadeoutpos = snd.fadeoutpos
-        looppos = snd.sound.loop
-        length = snd.sound.nframes
-        speed = SPEED[snd.note - snd.sound.midinote]
-        newsz = frame_count * speed
-        z = snd.sound.data
-        zz = <short *> (z.data)
-
-        N = frame_count
-
-        if (pos + frame_count * speed > length - 4) and (looppos == -1):
-            rmlist.append(snd)
-            N = <int> ((length - 4 - pos) / speed)
-
-        if snd.isfadeout:
-            if fadeoutpos > FADEOUTLENGTH: 
-                rmlist.append(snd)   
-            ii = 0   
-            for i in range(N):
-                j = pos + ii * speed
-                ii += 1                  
-                k = <int> j
-                if k > length - 2:
-                    pos = looppos + 1
-                    snd.pos = pos
-                    ii = 0
-                    j = pos + ii * speed   
-                    k = <int> j       
-                bb[2 * i] += (zz[2 * k] + (j - k) * (zz[2 * k + 2] - zz[2 * k])) * fadeout[fadeoutpos + i]                   # linear interpolation
-                bb[2 * i + 1] += (zz[2 * k + 1] + (j - k) * (zz[2 * k + 3] - zz[2 * k + 1])) * fadeout[fadeoutpos + i]        
-            snd.fadeoutpos += i
+cdef bint commit(Voice snd, VoiceState* v) except -1:
+    # writes the rendered state back, returns True when the voice has ended
+    snd.pos = v.pos * v.scale
+    snd.speed = v.speed1 * v.scale
+    snd.startframe = 0
+    if v.fading:
+        snd.isfadeout = True
+        snd.releaseframe = -1
+        snd.fadeoutpos = v.fadeoutpos
+    elif snd.releaseframe >= 0:                                             # release not reached (underrun): at the next block start
+        snd.releaseframe = 0
+    snd.underruns += v.underrun
+    return v.finished
+
+cdef inline short* tap(VoiceState* v, int k) noexcept nogil:
+    # frame k of the voice, clamped to the readable frames
+    if k < 0:
+        k = 0
+    elif k >= v.frames:
+        k = v.frames - 1
+    if v.streamed:
+        return streamframe(v.data, v.headframes, v.ring, v.ringframes, k, v.channels)
+    return v.data + v.channels * k
+
+cdef void renderhq(VoiceState* v, float* bb, int frame_count, float* fadeout, int FADEOUTLENGTH) noexcept nogil:
+    # same as render, with a polyphase table interpolation (cubic, sinc...) instead of the linear one
+    cdef int i, k, t, N, phase, first
+    cdef int margin = v.taps // 2 + 1
+    cdef double j, speed, dspeed, top
+    cdef float gl, gr, l, r
+    cdef bint ending
+    cdef float* c
+    cdef short* f
+
+    j = v.pos
+    speed = v.speed0
+    dspeed = (v.speed1 - v.speed0) / frame_count
+    top = max(v.speed0, v.speed1)                                           # bounds the frames read during the block
+    N = frame_count
+    if v.streamed:
+        ending = j + frame_count * top > v.length - 4
+        if ending:
+            N = <int> ((v.length - 4 - j) / top)
+        if v.filled < v.length and j + N * top + margin > v.filled:       # underrun: the reader thread is late
+            N = <int> ((v.filled - margin - j) / top)
+            ending = False
+            v.underrun = 1
+        v.finished = ending
+    elif (j + frame_count * top > v.length - 4) and (v.loop == -1):
+        v.finished = 1
+        N = <int> ((v.length - 4 - j) / top)
+    if N < 0:
+        N = 0
+    if v.fading and v.fadeoutpos > FADEOUTLENGTH:
+        v.finished = 1
 
+    gl = v.gainleft
+    gr = v.gainright
+    for i in range(N):
+        k = <int> j
+        if not v.streamed and k > v.length - 2:
+            j = v.loop + 1
+            k = <int> j
+        phase = <int> ((j - k) * v.phases)
+        c = v.table + phase * v.taps
+        first = k - v.taps // 2 + 1
+        l = 0
+        r = 0
+        if v.channels == 1:                                                 # mono: interpolated once, written to both sides
+            for t in range(v.taps):
+                l += c[t] * tap(v, first + t)[0]
+            r = l
         else:
-            ii = 0            
-            for i in range(N):
-                j = pos + ii * speed
-                ii += 1                  
+            for t in range(v.taps):
+                f = tap(v, first + t)
+                l += c[t] * f[0]
+                r += c[t] * f[1]
+        if v.fading:
+            gl = fadeout[v.fadeoutpos + i] * v.gainleft
+            gr = fadeout[v.fadeoutpos + i] * v.gainright
+        bb[2 * i] += l * gl
+        bb[2 * i + 1] += r * gr
+        j += speed
+        speed += dspeed
+    if v.fading:
+        v.fadeoutpos += N
+    v.pos = j
+
+cdef void render(VoiceState* v, float* bb, int frame_count, float* fadeout, int FADEOUTLENGTH) noexcept nogil:
+    # adds the next frame_count frames of the voice to bb, the speed gliding from speed0 to speed1
+    if v.taps > 2:
+        renderhq(v, bb, frame_count, fadeout, FADEOUTLENGTH)
+        return
+    cdef int i, k, N, length, looppos, fadeoutpos
+    cdef double j, speed, dspeed, top
+    cdef float x, y, f, gl = v.gainleft, gr = v.gainright
+    cdef bint ending
+    cdef short* zz = v.data
+    cdef short* fa
+    cdef short* fb
+
+    j = v.pos
+    speed = v.speed0
+    dspeed = (v.speed1 - v.speed0) / frame_count
+    top = max(v.speed0, v.speed1)                                           # bounds the frames read during the block
+    fadeoutpos = v.fadeoutpos
+    looppos = v.loop
+    length = v.length
+    N = frame_count
+
+    if v.streamed:
+        ending = j + frame_count * top > length - 4
+        if ending:
+            N = <int> ((length - 4 - j) / top)
+        if v.filled < length and j + N * top + 2 > v.filled:              # underrun: the reader thread is late
+            N = <int> ((v.filled - 2 - j) / top)
+            ending = False
+            v.underrun = 1
+        if N < 0:
+            N = 0
+        v.finished = ending or (v.fading and fadeoutpos > FADEOUTLENGTH)
+        for i in range(N):
+            k = <int> j
+            x = <float> (j - k)
+            fa = streamframe(zz, v.headframes, v.ring, v.ringframes, k, v.channels)
+            fb = streamframe(zz, v.headframes, v.ring, v.ringframes, k + 1, v.channels)
+            if v.fading:
+                gl = fadeout[fadeoutpos + i] * v.gainleft
+                gr = fadeout[fadeoutpos + i] * v.gainright
+            y = fa[0] + x * (fb[0] - fa[0])                                                                      # linear interpolation
+            bb[2 * i] += y * gl
+            if v.channels == 2:
+                y = fa[1] + x * (fb[1] - fa[1])
+            bb[2 * i + 1] += y * gr
+            j += speed
+            speed += dspeed
+        if v.fading:
+            v.fadeoutpos += N
+        v.pos = j
+        return
+
+    if (j + frame_count * top > length - 4) and (looppos == -1):
+        v.finished = 1
+        N = <int> ((length - 4 - j) / top)
+        if N < 0:
+            N = 0
+
+    if v.fading:
+        if fadeoutpos > FADEOUTLENGTH:
+            v.finished = 1
+        for i in range(N):
+            k = <int> j
+            if k > length - 2:
+                j = looppos + 1
+                k = <int> j
+            x = <float> (j - k)
+            f = fadeout[fadeoutpos + i]
+            if v.channels == 1:
+                y = (zz[k] + x * (zz[k + 1] - zz[k])) * f                                                          # linear interpolation
+                bb[2 * i] += y * gl
+                bb[2 * i + 1] += y * gr
+            else:
+                bb[2 * i] += (zz[2 * k] + x * (zz[2 * k + 2] - zz[2 * k])) * f * gl
+                bb[2 * i + 1] += (zz[2 * k + 1] + x * (zz[2 * k + 3] - zz[2 * k + 1])) * f * gr
+            j += speed
+            speed += dspeed
+        v.fadeoutpos += N
+
+    elif v.channels == 1:                                                   # mono: one interpolation, both sides
+        for i in range(N):
+            k = <int> j
+            if k > length - 2:
+                j = looppos + 1
+                k = <int> j
+            x = <float> (j - k)
+            y = zz[k] + x * (zz[k + 1] - zz[k])                                                                    # linear interpolation
+            bb[2 * i] += y * gl
+            bb[2 * i + 1] += y * gr
+            j += speed
+            speed += dspeed
+
+    else:
+        for i in range(N):
+            k = <int> j
+            if k > length - 2:
+                j = looppos + 1
                 k = <int> j
-                if k > length - 2:
-                    pos = looppos + 1
-                    snd.pos = pos
-                    ii = 0
-                    j = pos + ii * speed   
-                    k = <int> j  
-                bb[2 * i] += zz[2 * k] + (j - k) * (zz[2 * k + 2] - zz[2 * k])                                               # linear interpolation
-                bb[2 * i + 1] += zz[2 * k + 1] + (j - k) * (zz[2 * k + 3] - zz[2 * k + 1])
+            x = <float> (j - k)
+            bb[2 * i] += (zz[2 * k] + x * (zz[2 * k + 2] - zz[2 * k])) * gl                                        # linear interpolation
+            bb[2 * i + 1] += (zz[2 * k + 1] + x * (zz[2 * k + 3] - zz[2 * k + 1])) * gr
+            j += speed
+            speed += dspeed
+
+    v.pos = j
 
-        snd.pos += ii * speed
+cdef void renderblock(VoiceState* v, float* bb, int frame_count, float* fadeout, int FADEOUTLENGTH) noexcept nogil:
+    # renders the block from the voice's start frame, releasing it at its release frame (sample-accurate MIDI events)
+    cdef int start = min(max(v.startframe, 0), frame_count)
+    cdef int n = frame_count - start
+    cdef int d = v.releaseframe - start
+    cdef double speed1 = v.speed1
+    if n <= 0:
+        return
+    bb += 2 * start
+    if v.releaseframe >= 0 and d <= 0:
+        v.fading = 1
+    if v.fading or v.releaseframe < 0 or d >= n:
+        render(v, bb, n, fadeout, FADEOUTLENGTH)
+        return
+    v.speed1 = v.speed0 + (speed1 - v.speed0) * d / n                         # same glide, cut in two segments
+    render(v, bb, d, fadeout, FADEOUTLENGTH)
+    if v.finished or v.underrun:
+        v.speed1 = speed1
+        return
+    v.speed0 = v.speed1
+    v.speed1 = speed1
+    v.fading = 1
+    render(v, bb + 2 * d, n - d, fadeout, FADEOUTLENGTH)
+
+cdef VoiceState* states = NULL                                              # grown by preparevoices, never shrunk
+cdef int statecapacity = 0
+cdef list statevoices = []                                                  # Voice of each prepared state
+
+cdef int preparevoices(list playingsounds, list rmlist, numpy.ndarray SPEED, int cents) except -1:
+    # fills states from the playing voices, returns the number of states
+    global states, statecapacity
+    cdef int n = 0
+    cdef Voice snd
+    settle()                                                                # a late worker may still hold a state of the last block
+    if len(playingsounds) > statecapacity:
+        statecapacity = len(playingsounds) * 2
+        states = <VoiceState *> realloc(states, statecapacity * sizeof(VoiceState))
+        if states == NULL:
+            statecapacity = 0
+            raise MemoryError()
+    del statevoices[:]
+    for snd in playingsounds:
+        if prepare(snd, &states[n], <float *> (SPEED.data), len(SPEED), cents):
+            statevoices.append(snd)
+            n += 1
+        else:
+            rmlist.append(snd)
+    return n
+
+cdef commitvoices(int n, list rmlist, char* deferred=NULL):
+    # deferred: states not rendered in time, their voices are left as they were to play from there at the next block
+    cdef int i
+    for i in range(n):
+        if deferred != NULL and deferred[i]:
+            continue
+        if commit(<Voice> statevoices[i], &states[i]):
+            rmlist.append(statevoices[i])
+    del statevoices[:]
+
+def mixaudiobuffers(list playingsounds, list rmlist, int frame_count, numpy.ndarray FADEOUT, int FADEOUTLENGTH, numpy.ndarray SPEED, int cents=0):
+    # SPEED: ratio per cent of transposition, its middle entry is the unison; cents: pitch bend and tuning of the block
+    cdef numpy.ndarray b = numpy.zeros(2 * frame_count, numpy.float32)      # output buffer
+    cdef float* bb = <float *> (b.data)                                     # and its pointer
+    cdef float* fadeout = <float *> (FADEOUT.data)
+    cdef int i, n
+
+    n = preparevoices(playingsounds, rmlist, SPEED, cents)
+    with nogil:
+        for i in range(n):
+            renderblock(&states[i], bb, frame_count, fadeout, FADEOUTLENGTH)
+    commitvoices(n, rmlist)
 
     return b
 
+#########################################
+# PARALLEL MIXING
+#
+#########################################
+
+# the current job: states [0, jobcount) are cut in chunks of jobchunk voices, claimed with an atomic counter by the
+# audio thread and the MixWorkers threads; each participant mixes into its own row of subbuffers
+
+cdef int jobnext = 1 << 30                                                  # next state to claim; >= jobcount when no job is open
+cdef int jobcount = 0
+cdef int jobchunk = 4
+cdef int jobdone = 0                                                        # states rendered
+cdef int jobgeneration = 0
+cdef int jobexpired = 0                                                     # the audio thread stopped waiting: workers leave after their voice
+cdef int jobframes = 0
+cdef float* jobfadeout = NULL
+cdef int jobfadeoutlength = 0
+cdef numpy.ndarray subbuffers = numpy.zeros((1, 0), numpy.float32)
+cdef numpy.ndarray subgeneration = numpy.zeros(1, numpy.int32)             # job generation each row was last zeroed for
+cdef numpy.ndarray subbusy = numpy.zeros(1, numpy.int32)                   # 1 while the participant may write its row or a state
+cdef numpy.ndarray sublate = numpy.zeros(1, numpy.int32)                   # busy when the job expired: row and states left out
+cdef numpy.ndarray stateowner = numpy.zeros(0, numpy.int32)                # participant that rendered each state, -1 until then
+cdef numpy.ndarray statedeferred = numpy.zeros(0, numpy.int8)
+
+cdef void mixchunks(int participant) noexcept nogil:
+    cdef int first, last, i
+    cdef float* bb
+    cdef int* generation
+    cdef int* busy = <int *> subbusy.data
+    cdef int* owner
+    while True:
+        busy[participant] = 1                                               # before claiming: seen by a deadline that closes the job
+        __sync_synchronize()
+        first = __sync_fetch_and_add(&jobnext, jobchunk)
+        if first >= jobcount:
+            busy[participant] = 0
+            return
+        bb = (<float *> subbuffers.data) + participant * subbuffers.shape[1]        # read once the job is claimed
+        generation = <int *> subgeneration.data
+        if generation[participant] != jobgeneration:
+            memset(bb, 0, 2 * jobframes * sizeof(float))
+            generation[participant] = jobgeneration
+        owner = <int *> stateowner.data
+        last = min(first + jobchunk, jobcount)
+        for i in range(first, last):
+            if jobexpired:
+                break
+            renderblock(&states[i], bb, jobframes, jobfadeout, jobfadeoutlength)
+            owner[i] = participant
+        __sync_synchronize()
+        __sync_fetch_and_add(&jobdone, last - first)
+        busy[participant] = 0
+
+def workermix(int participant):
+    with nogil:
+        mixchunks(participant)
+
+class MixWorkers:
+    # helper threads for mixaudio; they only pick up work while a block is being mixed
+
+    def __init__(self, int nthreads, int chunk=4):
+        global subbuffers, subgeneration, subbusy, sublate, jobchunk
+        jobchunk = max(1, chunk)
+        subbuffers = numpy.zeros((nthreads + 1, 0), numpy.float32)
+        subgeneration = numpy.zeros(nthreads + 1, numpy.int32)
+        subbusy = numpy.zeros(nthreads + 1, numpy.int32)
+        sublate = numpy.zeros(nthreads + 1, numpy.int32)
+        self.events = []
+        for i in range(nthreads):
+            event = threading.Event()
+            thread = threading.Thread(target=self.run, args=(i + 1, event))
+            thread.daemon = True
+            thread.start()
+            self.events.append(event)
+
+    def run(self, participant, event):
+        while True:
+            event.wait()
+            event.clear()
+            workermix(participant)
+
+    def wake(self):
+        for event in self.events:
+            event.set()
+
+cdef inline double now() noexcept nogil:
+    cdef timespec ts
+    clock_gettime(CLOCK_MONOTONIC, &ts)
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+
+cdef void settle() noexcept nogil:
+    # waits for the workers that were still rendering when a job expired; they leave after their current voice
+    cdef int p
+    cdef int* busy = <int *> subbusy.data
+    for p in range(subbusy.shape[0]):
+        while busy[p]:
+            sched_yield()
+    __sync_synchronize()
+
+cdef int mixparallel(int n, float* bb, int frame_count, float* fadeout, int FADEOUTLENGTH, workers, double deadline) except -1:
+    # returns the number of voices deferred: those of the workers still rendering deadline seconds after the job
+    # was published are left out of this block (with the rest of these workers' rows), and play from where they
+    # were at the next one; deadline <= 0 waits for all of them
+    global jobnext, jobcount, jobdone, jobgeneration, jobexpired, jobframes, jobfadeout, jobfadeoutlength, subbuffers
+    global stateowner, statedeferred
+    cdef int p, i, rows, deferred = 0
+    cdef float* sub
+    cdef int* generation
+    cdef int* busy
+    cdef int* late
+    cdef int* owner
+    cdef char* skip
+    cdef double limit
+    if subbuffers.shape[1] < 2 * frame_count:
+        subbuffers = numpy.zeros((subbuffers.shape[0], 2 * frame_count), numpy.float32)
+    if len(stateowner) < n:
+        stateowner = numpy.zeros(2 * n, numpy.int32)
+        statedeferred = numpy.zeros(2 * n, numpy.int8)
+    owner = <int *> stateowner.data
+    skip = <char *> statedeferred.data
+    busy = <int *> subbusy.data
+    late = <int *> sublate.data
+    rows = subbuffers.shape[0]
+    for i in range(n):
+        owner[i] = -1
+    jobcount = n
+    jobframes = frame_count
+    jobfadeout = fadeout
+    jobfadeoutlength = FADEOUTLENGTH
+    jobdone = 0
+    jobexpired = 0
+    jobgeneration += 1
+    __sync_synchronize()
+    limit = now() + deadline
+    jobnext = 0                                                             # publish the job
+    workers.wake()
+    with nogil:
+        mixchunks(0)                                                        # the audio thread works too: late workers find nothing left
+        while jobdone < n:                                                  # wait for chunks still being rendered by workers
+            if deadline > 0 and now() > limit:
+                jobexpired = 1
+                break
+            sched_yield()
+        jobnext = 1 << 30
+        __sync_synchronize()
+        generation = <int *> subgeneration.data
+        if jobexpired:                                                      # rows still being written are left out, with their states
+            for p in range(rows):
+                late[p] = busy[p]
+            __sync_synchronize()
+            for i in range(n):
+                skip[i] = owner[i] < 0 or late[owner[i]]
+                deferred += skip[i]
+        for p in range(rows):
+            if generation[p] == jobgeneration and not (jobexpired and late[p]):
+                sub = (<float *> subbuffers.data) + p * subbuffers.shape[1]
+                for i in range(2 * frame_count):
+                    bb[i] += sub[i]
+    return deferred
+
+#########################################
+# FUSED OUTPUT
+#
+#########################################
+
+cdef numpy.ndarray mixbuffer = numpy.zeros(0, numpy.float32)                # reused by mixaudio, grown when needed
+
+def mixaudio(list playingsounds, list rmlist, numpy.ndarray outdata, int frame_count, float gain, float softclipknee,
+             numpy.ndarray FADEOUT, int FADEOUTLENGTH, numpy.ndarray SPEED, workers=None, int parallelmin=0, int cents=0,
+             double deadline=0):
+    # mixes into a preallocated buffer (on the MixWorkers too when given and at least parallelmin voices play, waiting
+    # for them at most deadline seconds), then applies gain, soft clipping above softclipknee (fraction of full scale,
+    # 0 to disable) and int16 saturation while writing outdata, in one pass; returns the number of voices deferred to
+    # the next block because their worker was late
+    global mixbuffer
+    cdef int i, n, deferred = 0
+    cdef float x, a, knee, room
+    cdef float* fadeout = <float *> (FADEOUT.data)
+    cdef short* out = <short *> (outdata.data)
+
+    if not outdata.flags.c_contiguous or outdata.dtype != numpy.int16 or outdata.size < 2 * frame_count:
+        raise ValueError("outdata must be a contiguous int16 buffer of frame_count stereo frames")
+    if len(mixbuffer) < 2 * frame_count:
+        mixbuffer = numpy.zeros(2 * frame_count, numpy.float32)
+    cdef float* bb = <float *> (mixbuffer.data)
+    memset(bb, 0, 2 * frame_count * sizeof(float))
+
+    n = preparevoices(playingsounds, rmlist, SPEED, cents)
+    if workers is not None and n >= parallelmin:
+        deferred = mixparallel(n, bb, frame_count, fadeout, FADEOUTLENGTH, workers, deadline)
+    else:
+        with nogil:
+            for i in range(n):
+                renderblock(&states[i], bb, frame_count, fadeout, FADEOUTLENGTH)
+    commitvoices(n, rmlist, <char *> statedeferred.data if deferred else NULL)
+
+    knee = softclipknee * 32767
+    room = 32767 - knee
+    with nogil:
+        for i in range(2 * frame_count):
+            x = bb[i] * gain
+            if softclipknee > 0:
+                a = x if x > 0 else -x
+                if a > knee:                                                # smooth saturation towards full scale
+                    a = knee + room * tanhf((a - knee) / room)
+                    x = a if x > 0 else -a
+            if x > 32767:
+                x = 32767
+            elif x < -32768:
+                x = -32768
+            out[i] = <short> lrintf(x)
+    return deferred
+
 def binary24_to_int16(char *data, int length):
     cdef int i
     res = numpy.zeros(length, numpy.int16)
-    b = <char *>((<numpy.ndarray>res).data)
-    for i in range(length):
-        b[2*i] = data[3*i+1]
-        b[2*i+1] = data[3*i+2]
-    return res
\ No newline at end of file
+    cdef char* b = <char *>((<numpy.ndarray>res).data)
+    with nogil:                 # lets the loading threads decode in parallel
+        for i in range(length):
+            b[2*i] = data[3*i+1]
+            b[2*i+1] = data[3*i+2]
+    return res
@@ -0,0 +1,94 @@
+#
+#  SamplerBox
+#
+#  test_controls.py: ControlSurface with the console mock backends
+#
+#  usage:  python3 -m pytest tests
+#
+
+import io
+import os
+import sys
+import time
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import samplerbox
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class SlowDisplay(samplerbox.ConsoleDisplay):
+    '''Console display whose first write blocks until released, as a slow I2C display would'''
+
+    def __init__(self):
+        self.written = []
+        self.release = threading.Event()
+
+    def write(self, text):
+        samplerbox.ConsoleDisplay.write(self, text)
+        self.written.append(text)
+        self.release.wait()
+
+
+def test_display_writes_only_the_latest_text(capsys):
+    controls = samplerbox.ControlSurface()
+    backend = SlowDisplay()
+    controls.displays.append(backend)
+    controls.start()
+    controls.show("L001")
+    assert wait_until(lambda: backend.written == ["L001"])
+    for text in ("L002", "L003", "0003"):       # shown while the display is busy: only the last one is written
+        controls.show(text)
+    backend.release.set()
+    assert wait_until(lambda: len(backend.written) == 2)
+    time.sleep(0.1)
+    assert backend.written == ["L001", "0003"]
+    assert "Display: 0003" in capsys.readouterr().out
+    controls.show("0003")                       # unchanged text: not written again
+    time.sleep(0.1)
+    assert backend.written == ["L001", "0003"]
+
+
+def test_console_keys_dispatch_the_button_actions(monkeypatch):
+    done = []
+    monkeypatch.setitem(samplerbox.CONTROL_ACTIONS, 'previous', lambda: done.append('previous'))
+    monkeypatch.setitem(samplerbox.CONTROL_ACTIONS, 'next', lambda: done.append('next'))
+    monkeypatch.setattr(samplerbox, 'sys_stdin', io.StringIO("+x-\n++\n"))
+    controls = samplerbox.ControlSurface()
+    controls.inputs.append(samplerbox.ConsoleInput())
+    controls.start()
+    assert wait_until(lambda: len(done) == 4)
+    assert done == ['next', 'previous', 'next', 'next']
+
+
+def test_a_failing_action_does_not_stop_the_dispatcher(monkeypatch):
+    done = []
+
+    def fail():
+        raise Exception("load failed")
+    monkeypatch.setitem(samplerbox.CONTROL_ACTIONS, 'previous', fail)
+    monkeypatch.setitem(samplerbox.CONTROL_ACTIONS, 'next', lambda: done.append('next'))
+    controls = samplerbox.ControlSurface()
+    controls.inputs.append(samplerbox.ConsoleInput())
+    monkeypatch.setattr(samplerbox, 'sys_stdin', io.StringIO("-+\n"))
+    controls.start()
+    assert wait_until(lambda: done == ['next'])
+
+
+def test_buttons_wrap_around_and_the_keyboard_stops_at_zero(monkeypatch):
+    monkeypatch.setattr(samplerbox, 'LoadSamples', lambda: None)
+    monkeypatch.setattr(samplerbox, 'preset', 0)
+    samplerbox.CONTROL_ACTIONS['previous']()
+    assert samplerbox.preset == 127
+    samplerbox.CONTROL_ACTIONS['next']()
+    assert samplerbox.preset == 0
+    samplerbox.CONTROL_ACTIONS['down']()
+    assert samplerbox.preset == 0
+    samplerbox.CONTROL_ACTIONS['up']()
+    assert samplerbox.preset == 1
@@ -0,0 +1,73 @@
+#
+#  SamplerBox
+#
+#  test_keymap.py: Keymap cells against the per-cell fill of the original loader
+#
+#  usage:  python3 -m pytest tests
+#
+
+import os
+import sys
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import samplerbox
+
+
+def reference_fill(samples):
+    '''{(midinote, velocity): sample} filled as the original loader did: missing velocities use the layer below
+    (the first layer below it), notes without samples use the note below'''
+    initial_keys = set(samples.keys())
+    for midinote in range(128):
+        lastvelocity = None
+        for velocity in range(128):
+            if (midinote, velocity) not in initial_keys:
+                samples[midinote, velocity] = lastvelocity
+            else:
+                if not lastvelocity:
+                    for v in range(velocity):
+                        samples[midinote, v] = samples[midinote, velocity]
+                lastvelocity = samples[midinote, velocity]
+        if not lastvelocity:
+            for velocity in range(128):
+                samples[midinote, velocity] = samples.get((midinote - 1, velocity))
+    return samples
+
+
+def random_preset(rng):
+    samples = {}
+    for midinote in rng.sample(range(128), rng.randint(1, 20)):
+        for velocity in rng.sample(range(128), rng.randint(1, 4)):
+            samples[midinote, velocity] = "{}/{}".format(midinote, velocity)
+    return samples
+
+
+def test_fill_matches_the_original_loader():
+    rng = random.Random(1234)
+    for preset in range(50):
+        samples = random_preset(rng)
+        keymap = samplerbox.Keymap({(midinote, velocity, 0): sample for (midinote, velocity), sample in samples.items()})
+        expected = reference_fill(dict(samples))
+        for midinote in range(128):
+            for velocity in range(128):
+                layer = keymap.lower[midinote << 7 | velocity]
+                assert (keymap.layers[layer][0] if layer >= 0 else None) == expected[midinote, velocity]
+                assert keymap.upper[midinote << 7 | velocity] == -1
+
+
+def test_empty_keymap():
+    keymap = samplerbox.Keymap({})
+    assert (keymap.lower == -1).all() and (keymap.upper == -1).all()
+
+
+def test_crossfade_blends_only_between_layers():
+    keymap = samplerbox.Keymap({(60, 40, 0): "soft", (60, 100, 0): "loud"}, crossfade=True)
+    cells = [60 << 7 | velocity for velocity in range(128)]
+    soft, loud = [keymap.layers.index([name]) for name in ("soft", "loud")]
+    for velocity, cell in enumerate(cells):
+        if 40 < velocity < 100:
+            assert (keymap.lower[cell], keymap.upper[cell]) == (soft, loud)
+            assert abs(keymap.blend[cell] - (velocity - 40) / 60.0) < 1e-6
+        else:       # on a layer or outside of the two, one voice
+            assert keymap.upper[cell] == -1
+            assert keymap.lower[cell] == (loud if velocity >= 100 else soft)
@@ -0,0 +1,76 @@
+#
+#  SamplerBox
+#
+#  test_midiports.py: MidiPorts.refresh against a stubbed rtmidi2 port listing
+#
+#  usage:  python3 -m pytest tests
+#
+
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import samplerbox
+
+
+class FakeRtmidi(types.ModuleType):
+    '''rtmidi2 stand-in: the ports listed are those of self.ports, MidiIn instances record what they open'''
+
+    def __init__(self):
+        types.ModuleType.__init__(self, 'rtmidi2')
+        self.ports = []
+        self.broken = set()             # ports whose open_port fails
+        self.log = []
+        rtmidi = self
+
+        class MidiIn:
+            def open_port(self, port):
+                if port in rtmidi.broken:
+                    raise Exception("busy")
+                self.port = port
+                rtmidi.log.append(('open', port))
+
+            def close_port(self):
+                rtmidi.log.append(('close', self.port))
+        self.MidiIn = MidiIn
+
+    def get_in_ports(self):
+        return list(self.ports)
+
+
+def midiports(monkeypatch):
+    rtmidi = FakeRtmidi()
+    monkeypatch.setitem(sys.modules, 'rtmidi2', rtmidi)
+    return samplerbox.MidiPorts(), rtmidi
+
+
+def test_refresh_opens_new_ports_and_closes_vanished_ones(monkeypatch):
+    ports, rtmidi = midiports(monkeypatch)
+    rtmidi.ports = ['Midi Through:0', 'Keyboard:0', 'Pads:0']
+    ports.refresh()
+    assert rtmidi.log == [('open', 'Keyboard:0'), ('open', 'Pads:0')]
+    assert set(ports.opened) == {'Keyboard:0', 'Pads:0'}
+    assert ports.opened['Keyboard:0'].callback is samplerbox.MidiCallback
+    keyboard = ports.opened['Keyboard:0']
+
+    del rtmidi.log[:]
+    rtmidi.ports = ['Midi Through:0', 'Keyboard:0', 'Drums:0']      # pads unplugged, drums plugged in
+    ports.refresh()
+    assert rtmidi.log == [('close', 'Pads:0'), ('open', 'Drums:0')]
+    assert ports.opened['Keyboard:0'] is keyboard                   # untouched
+
+    del rtmidi.log[:]
+    ports.refresh()
+    assert rtmidi.log == []
+
+
+def test_a_port_that_cannot_be_opened_is_retried(monkeypatch):
+    ports, rtmidi = midiports(monkeypatch)
+    rtmidi.ports = ['Keyboard:0']
+    rtmidi.broken = {'Keyboard:0'}
+    ports.refresh()
+    assert ports.opened == {}
+    rtmidi.broken = set()
+    ports.refresh()
+    assert rtmidi.log == [('open', 'Keyboard:0')]
@@ -0,0 +1,57 @@
+#
+#  SamplerBox
+#
+#  test_midistream.py: MidiStreamParser on serial MIDI byte streams
+#
+#  usage:  python3 -m pytest tests
+#
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import samplerbox
+
+
+def parse(data, chunk=None):
+    '''Messages parsed from data, fed whole or chunk bytes at a time'''
+    messages = []
+    parser = samplerbox.MidiStreamParser(messages.append)
+    chunk = chunk or len(data) or 1
+    for i in range(0, len(data), chunk):
+        parser.feed(data[i:i + chunk])
+    return messages
+
+
+def test_complete_messages():
+    assert parse(bytes([0x90, 60, 100, 0x80, 60, 0, 0xC1, 5, 0xE0, 0, 64])) == [[0x90, 60, 100], [0x80, 60, 0], [0xC1, 5], [0xE0, 0, 64]]
+
+
+def test_running_status():
+    assert parse(bytes([0x90, 60, 100, 62, 100, 64, 0])) == [[0x90, 60, 100], [0x90, 62, 100], [0x90, 64, 0]]
+    assert parse(bytes([0xC0, 5, 6])) == [[0xC0, 5], [0xC0, 6]]
+
+
+def test_realtime_bytes_are_stripped_even_inside_a_message():
+    assert parse(bytes([0xF8, 0x90, 0xF8, 60, 0xFE, 100, 0xFA, 62, 0xFC, 90])) == [[0x90, 60, 100], [0x90, 62, 90]]
+
+
+def test_sysex_is_skipped():
+    assert parse(bytes([0xF0, 0x7E, 0x7F, 0x06, 0x01, 0xF7, 0x80, 60, 0])) == [[0x80, 60, 0]]
+    assert parse(bytes([0xF0, 1, 2, 0x90, 60, 100])) == [[0x90, 60, 100]]      # unterminated, ended by the next status
+
+
+def test_system_common_cancels_running_status():
+    assert parse(bytes([0x90, 60, 100, 0xF6, 61, 100, 0x90, 62, 100])) == [[0x90, 60, 100], [0xF6], [0x90, 62, 100]]
+
+
+def test_stray_data_bytes_are_ignored():
+    assert parse(bytes([60, 100, 0x90, 60, 100])) == [[0x90, 60, 100]]
+
+
+def test_chunking_does_not_change_the_messages():
+    data = bytes([0xF8, 0x90, 60, 100, 62, 0xF8, 100, 0xF0, 1, 2, 0xF7, 0xB0, 64, 127, 0xC0, 3, 0x80, 60, 0, 62, 0])
+    expected = parse(data)
+    assert len(expected) == 6
+    for chunk in range(1, len(data)):
+        assert parse(data, chunk) == expected
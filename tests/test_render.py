@@ -0,0 +1,79 @@
+#
+#  SamplerBox
+#
+#  test_render.py: offline rendering of a MIDI file against a generated preset
+#
+#  usage:  python3 -m pytest tests
+#
+
+import os
+import sys
+import wave
+import struct
+import hashlib
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import samplerbox
+
+DIVISION = 480                  # ticks per quarter note; at the default tempo (120 bpm) a tick is 1/960 s
+
+
+def write_sample(filename, frames):
+    '''Mono 16-bit constant signal: the output is exactly zero before a note starts and after it ends'''
+    w = wave.open(filename, 'wb')
+    w.setnchannels(1)
+    w.setsampwidth(2)
+    w.setframerate(samplerbox.SAMPLERATE)
+    w.writeframes(numpy.full(frames, 8000, '<i2').tobytes())
+    w.close()
+
+
+def write_midi(filename, events):
+    '''Format 0 SMF of (tick, message) events'''
+    track, last = b'', 0
+    for tick, message in events:
+        track += bytes([tick - last]) if tick - last < 128 else bytes([0x80 | (tick - last) >> 7, (tick - last) & 0x7F])
+        track += bytes(message)
+        last = tick
+    track += b'\x00\xff\x2f\x00'
+    with open(filename, 'wb') as f:
+        f.write(b'MThd' + struct.pack('>IHHh', 6, 0, 1, DIVISION))
+        f.write(b'MTrk' + struct.pack('>I', len(track)) + track)
+
+
+def render(tmpdir, events):
+    os.mkdir(os.path.join(tmpdir, "0 Test"))
+    write_sample(os.path.join(tmpdir, "0 Test", "60.wav"), samplerbox.SAMPLERATE // 20)
+    write_midi(os.path.join(tmpdir, "a.mid"), events)
+    samplerbox.SAMPLES_DIR = tmpdir
+    samplerbox.Library.scan()
+    samplerbox.OfflineRender = True
+    try:
+        samplerbox.preset = 0
+        samplerbox.ActuallyLoad()
+        samplerbox.RenderPreset = (0, samplerbox.PendingPresets.popleft())
+        outputs = []
+        for name in ("a.wav", "b.wav"):
+            samplerbox.RenderMidiFile(os.path.join(tmpdir, "a.mid"), os.path.join(tmpdir, name))
+            w = wave.open(os.path.join(tmpdir, name), 'rb')
+            outputs.append(w.readframes(w.getnframes()))
+            w.close()
+    finally:
+        samplerbox.OfflineRender = False
+        samplerbox.SAMPLES_DIR = "."
+        samplerbox.Library.folders = None
+    return outputs
+
+
+def test_render_is_deterministic_and_sample_accurate(tmp_path):
+    events = [(96, [0x90, 60, 127]), (288, [0x90, 60, 100]), (336, [0x80, 60, 0])]     # at 0.1 s, 0.3 s, off at 0.35 s
+    first, second = render(str(tmp_path), events)
+    assert hashlib.sha1(first).hexdigest() == hashlib.sha1(second).hexdigest()
+    left = numpy.frombuffer(first, numpy.int16)[0::2]
+    sounding = numpy.flatnonzero(left)
+    onsets = sounding[numpy.diff(numpy.concatenate([[-2], sounding])) > 1]
+    assert onsets.tolist() == [int(round(tick / 960.0 * samplerbox.SAMPLERATE)) for tick, message in events[:2]]
+    assert len(left) % samplerbox.BLOCKSIZE == 0
+    assert len(left) - sounding[-1] <= samplerbox.BLOCKSIZE        # stops at the block where the last voice ended
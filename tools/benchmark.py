@@ -0,0 +1,246 @@
+#
+#  SamplerBox
+#
+#  benchmark.py: Headless benchmark of the mixer (samplerbox_audio.mixaudio, on the MixWorkers
+#                too with --threads) and of the AudioCallback path, with synthetic voices.
+#
+#  No soundcard, sounddevice or rtmidi is needed: the synthetic samples are written
+#  as WAV files in a temporary folder and loaded through samplerbox.Sound, then the
+#  mixer is driven block by block and timed against the audio deadline.
+#
+#  usage:  python3 tools/benchmark.py [--blocks 200] [--voices 1,16,64,128,256] ...
+#
+
+import os
+import sys
+import time
+import wave
+import struct
+import shutil
+import argparse
+import tempfile
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import samplerbox
+import samplerbox_audio
+
+BLOCKSIZE = samplerbox.BLOCKSIZE
+SAMPLERATE = samplerbox.SAMPLERATE
+DEADLINE = float(BLOCKSIZE) / SAMPLERATE
+
+WORKLOADS = ["oneshot", "looped", "fadeout"]
+
+
+#########################################
+# SYNTHETIC SAMPLES
+#
+#########################################
+
+def write_wav(filename, seconds, loop=None, channels=2):
+    '''Write a 16-bit noisy sine, optionally with a smpl loop chunk (start, end) in frames'''
+    nframes = int(seconds * SAMPLERATE)
+    t = numpy.arange(nframes) / float(SAMPLERATE)
+    mono = 0.5 * numpy.sin(2 * numpy.pi * 220.0 * t) + 0.05 * numpy.random.uniform(-1, 1, nframes)
+    data = (numpy.repeat(mono, channels) * 16000).astype('<i2').tobytes()
+    w = wave.open(filename, 'wb')
+    w.setnchannels(channels)
+    w.setsampwidth(2)
+    w.setframerate(SAMPLERATE)
+    w.writeframes(data)
+    w.close()
+    if loop:
+        smpl = struct.pack('<iiiiiiiii', 0, 0, 0, 60, 0, 0, 0, 1, 0) + struct.pack('<iiiiii', 0, 0, loop[0], loop[1], 0, 0)
+        with open(filename, 'r+b') as f:
+            f.seek(0, 2)
+            f.write(b'smpl' + struct.pack('<i', len(smpl)) + smpl)
+            size = f.tell() - 8
+            f.seek(4)
+            f.write(struct.pack('<i', size))
+
+
+def make_sounds(tmpdir, channels):
+    oneshot = os.path.join(tmpdir, "oneshot.wav")
+    looped = os.path.join(tmpdir, "looped.wav")
+    write_wav(oneshot, 4.0, channels=channels)
+    write_wav(looped, 1.0, loop=(SAMPLERATE // 4, SAMPLERATE - 100), channels=channels)
+    return {"oneshot": samplerbox.Sound(oneshot, 60, 127),
+            "looped": samplerbox.Sound(looped, 60, 127)}
+
+
+#########################################
+# WORKLOAD DRIVER
+#
+#########################################
+
+class Workload:
+
+    def __init__(self, name, sounds, voices, transpose):
+        self.name = name
+        self.sound = sounds["oneshot"] if name == "oneshot" else sounds["looped"]
+        self.voices = voices
+        self.transpose = transpose
+        self.rng = numpy.random.RandomState(1234)
+
+    def newvoice(self):
+        snd = samplerbox.PlayingSound(self.sound, self.sound.midinote + self.transpose)
+        if self.name == "oneshot":
+            snd.pos = self.rng.randint(0, self.sound.nframes // 2)
+        elif self.name == "fadeout":
+            snd.fadeout(50)
+            snd.fadeoutpos = self.rng.randint(0, samplerbox.FADEOUTLENGTH)
+        else:
+            snd.pos = self.rng.randint(0, self.sound.nframes - 10)
+        return snd
+
+    def topup(self, playingsounds):
+        '''Keep the number of voices constant, as a player holding a chord would'''
+        while len(playingsounds) < self.voices:
+            playingsounds.append(self.newvoice())
+        return playingsounds
+
+
+def run_kernel(workload, blocks):
+    '''The mixer AudioCallback uses: mixaudio (mixing, gain, soft clip, int16 output), on samplerbox.mixworkers too
+    when set, waiting for all of them; mixaudiobuffers, the allocating float mixer, with USE_FUSED_MIX = False'''
+    playingsounds = workload.topup([])
+    outdata = numpy.zeros((BLOCKSIZE, 2), numpy.int16)
+    times = numpy.zeros(blocks)
+    for n in range(blocks):
+        rmlist = []
+        t0 = time.perf_counter()
+        if samplerbox.USE_FUSED_MIX:
+            samplerbox_audio.mixaudio(playingsounds, rmlist, outdata, BLOCKSIZE, samplerbox.globalvolume, samplerbox.SOFT_CLIP_KNEE,
+                                      samplerbox.FADEOUT, samplerbox.FADEOUTLENGTH, samplerbox.SPEED, samplerbox.mixworkers, 0)
+        else:
+            samplerbox_audio.mixaudiobuffers(playingsounds, rmlist, BLOCKSIZE, samplerbox.FADEOUT, samplerbox.FADEOUTLENGTH, samplerbox.SPEED)
+        times[n] = time.perf_counter() - t0
+        for e in rmlist:
+            try:
+                playingsounds.remove(e)
+            except ValueError:
+                pass
+        workload.topup(playingsounds)
+    return times
+
+
+def run_callback(workload, blocks):
+    '''Full path: note messages through MidiCallback, applied by AudioCallback at their frame through the keymap and
+    the voice pool, then mixing, gain and output. workload.voices must not exceed MAX_POLYPHONY: above it, each
+    note-on would steal a voice, and the block times would measure the stealing rather than the mixing.'''
+    outdata = numpy.zeros((BLOCKSIZE, 2), numpy.int16)
+    samplerbox.MAX_VOICES_PER_NOTE = 100000      # all synthetic voices play the same key
+    samplerbox.PARALLEL_MIX_MIN_VOICES = 0
+    samplerbox.globaltranspose = 0
+    samplerbox.keymap = samplerbox.Keymap({(workload.sound.midinote, 0, 0): workload.sound}, nearest=True)
+    samplerbox.playingnotes = {}
+    pool = samplerbox.voicepool = samplerbox.VoicePool(samplerbox.MAX_POLYPHONY)
+    note = workload.sound.midinote + workload.transpose
+    times = numpy.zeros(blocks)
+    for n in range(blocks):
+        for i in range(workload.voices - len(pool.active)):
+            samplerbox.MidiCallback([0x90, note, 127], None)
+            if workload.name == "fadeout":
+                samplerbox.MidiCallback([0x80, note, 0], None)
+        t0 = time.perf_counter()
+        samplerbox.AudioCallback(outdata, BLOCKSIZE, None, None)
+        times[n] = time.perf_counter() - t0
+        samplerbox.playingnotes = {}            # the synthetic voices are stolen, never released by a note-off
+    samplerbox.voicepool = samplerbox.VoicePool(samplerbox.MAX_POLYPHONY)
+    samplerbox.keymap = samplerbox.Keymap({})
+    return times
+
+
+#########################################
+# REPORT
+#
+#########################################
+
+def fit(voices, times):
+    '''Linear fit of block time vs voice count: (seconds per voice, fixed seconds per block)'''
+    if len(voices) < 2:
+        return None, None
+    return numpy.polyfit(voices, times, 1)
+
+
+def safe_polyphony(voices, p99, headroom):
+    '''Linear fit of p99 block time vs voice count, solved for the deadline * headroom'''
+    slope, intercept = fit(voices, p99)
+    if slope is None or slope <= 0:
+        return None
+    return max(0, int((DEADLINE * headroom - intercept) / slope))
+
+
+def benchmark(args):
+    global BLOCKSIZE, DEADLINE
+    if args.blocksize:
+        BLOCKSIZE = args.blocksize
+        DEADLINE = float(BLOCKSIZE) / SAMPLERATE
+    tmpdir = tempfile.mkdtemp(prefix="samplerbox-bench-")
+    try:
+        sounds = make_sounds(tmpdir, 1 if args.mono else 2)
+        if args.polyphony:
+            samplerbox.MAX_POLYPHONY = args.polyphony
+        if args.unfused:
+            samplerbox.USE_FUSED_MIX = False
+        elif args.threads:
+            samplerbox.mixworkers = samplerbox_audio.MixWorkers(args.threads)
+        if args.mipmaps:
+            for sound in sounds.values():
+                sound.buildmipmaps(max(args.transpose) // 12)
+        paths = [("kernel", run_kernel)]
+        if not args.kernel_only:
+            paths.append(("callback", run_callback))
+        print("Deadline: {:.3f} ms per block ({} frames at {} Hz), headroom {:.0%}, MAX_POLYPHONY {}, mixer {} on {} threads, {} samples\n".format(
+            DEADLINE * 1000, BLOCKSIZE, SAMPLERATE, args.headroom, samplerbox.MAX_POLYPHONY,
+            "mixaudio" if samplerbox.USE_FUSED_MIX else "mixaudiobuffers", 1 if args.unfused else 1 + args.threads, "mono" if args.mono else "stereo"))
+        print("{:<9} {:<7} {:<8} {:>5} {:>7} {:>9} {:>9} {:>9} {:>9} {:>7}".format(
+            "path", "interp", "workload", "semi", "voices", "mean ms", "p50 ms", "p99 ms", "max ms", "load"))
+        for pathname, run in paths:
+            for interpolation in args.interpolation:
+                samplerbox.globalinterpolation = samplerbox.INTERPOLATION_MODES[interpolation]
+                for name in args.workloads:
+                    for transpose in args.transpose:
+                        means, p99s = [], []
+                        counts = args.voices
+                        if pathname == "callback":      # no more voices than the pool holds, see run_callback
+                            counts = sorted(set(min(voices, samplerbox.MAX_POLYPHONY) for voices in counts))
+                        for voices in counts:
+                            times = run(Workload(name, sounds, voices, transpose), args.blocks)
+                            p50, p99 = numpy.percentile(times, [50, 99])
+                            means.append(times.mean())
+                            p99s.append(p99)
+                            print("{:<9} {:<7} {:<8} {:>5} {:>7} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>6.0%}".format(
+                                pathname, interpolation, name, transpose, voices, times.mean() * 1000, p50 * 1000, p99 * 1000, times.max() * 1000, p99 / DEADLINE))
+                        pervoice = fit(counts, means)[0]
+                        cost = "{:.2f} us per voice".format(pervoice * 1e6) if pervoice is not None else "n/a"
+                        if pathname == "callback":
+                            print("  -> {}; voice counts capped at MAX_POLYPHONY = {} (--polyphony) in this path".format(cost, samplerbox.MAX_POLYPHONY))
+                        else:
+                            safe = safe_polyphony(counts, p99s, args.headroom)
+                            print("  -> {}; max safe polyphony: {}".format(cost, safe if safe is not None else "n/a"))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def intlist(s):
+    return [int(x) for x in s.split(',') if x.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless SamplerBox mixer benchmark")
+    parser.add_argument("--blocks", type=int, default=200, help="audio blocks timed per case")
+    parser.add_argument("--voices", type=intlist, default=[1, 16, 32, 64, 80, 128, 192, 256], help="comma separated voice counts")
+    parser.add_argument("--transpose", type=intlist, default=[0, 7, 12, 24], help="comma separated semitone offsets, negative ones transpose down")
+    parser.add_argument("--workloads", type=lambda s: s.split(','), default=WORKLOADS, help="comma separated, among: " + ",".join(WORKLOADS))
+    parser.add_argument("--interpolation", type=lambda s: s.split(','), default=["linear"], help="comma separated, among: " + ",".join(samplerbox.INTERPOLATION_MODES))
+    parser.add_argument("--headroom", type=float, default=0.7, help="fraction of the deadline a block may use to count as safe")
+    parser.add_argument("--mono", action="store_true", help="mono synthetic samples (native mono voice path)")
+    parser.add_argument("--mipmaps", action="store_true", help="build octave mipmaps of the synthetic samples (USE_MIPMAPS)")
+    parser.add_argument("--threads", type=int, default=0, help="MixWorkers helper threads (MIX_THREADS)")
+    parser.add_argument("--polyphony", type=int, default=0, help="override MAX_POLYPHONY in the callback path")
+    parser.add_argument("--blocksize", type=int, default=0, help="frames per block, e.g. 128 (default: BLOCKSIZE of samplerbox.py)")
+    parser.add_argument("--kernel-only", action="store_true", help="skip the AudioCallback path")
+    parser.add_argument("--unfused", action="store_true", help="time mixaudiobuffers, the float mixer of USE_FUSED_MIX = False, single thread")
+    benchmark(parser.parse_args())